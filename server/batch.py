@@ -0,0 +1,143 @@
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import zipfile
+
+from options import OUTPUT_FORMATS, output_options
+from uploads import MAX_UPLOAD_BYTES, UploadTooLarge, read_upload
+
+log = logging.getLogger("batchbg.batch")
+
+# A batch is read into memory before it streams: bound the file count and total size
+MAX_BATCH_FILES = int(os.getenv("BATCHBG_MAX_BATCH_FILES", 100))
+MAX_BATCH_BYTES = int(os.getenv("BATCHBG_MAX_BATCH_MB", 200)) * 1024 * 1024
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only, unseekable sink. zipfile falls back to data descriptors for these,
+    so each entry can be flushed to the client as soon as it is written."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _output_name(filename, index, used, ext):
+    stem = os.path.splitext(os.path.basename(filename or ""))[0] or f"image-{index:03d}"
+    name = f"{stem}-editado.{ext}"
+    if name in used:
+        name = f"{stem}-{index:03d}-editado.{ext}"
+    used.add(name)
+    return name
+
+
+async def read_uploads(files, max_files=MAX_BATCH_FILES, max_bytes=MAX_BATCH_BYTES):
+    # Uploads are closed once the endpoint returns, before the response streams,
+    # so their contents must be read up front. Raises UploadTooLarge past the limits.
+    if len(files) > max_files:
+        raise UploadTooLarge(f"Batch of {len(files)} files exceeds the {max_files} file limit")
+    too_large = UploadTooLarge(f"Batch exceeds the {max_bytes // (1024 * 1024)} MB total upload limit")
+    items = []
+    remaining = max_bytes
+    for upload in files:
+        try:
+            # Never read more than what is left of the batch budget
+            data = await read_upload(upload, max_bytes=min(MAX_UPLOAD_BYTES, remaining))
+        except UploadTooLarge:
+            if remaining < MAX_UPLOAD_BYTES:
+                raise too_large
+            raise
+        remaining -= len(data)
+        items.append((upload.filename, data))
+    return items
+
+
+async def _completed(batcher, items, task, instruction, params, output):
+    """Yield (index, filename, output_bytes | Exception) as each item finishes.
+    Items are grouped into chunks of batcher.max_batch so each chunk shares one forward pass."""
+
+    async def run_chunk(start, chunk):
+        try:
+            results = await batcher.run_many(
+                [data for _, data in chunk], task=task, instruction=instruction, params=params, output=output
+            )
+        except Exception as e:
+            results = [e] * len(chunk)
+        return [(start + i, name, result) for i, ((name, _), result) in enumerate(zip(chunk, results))]
+
+    size = batcher.max_batch
+    tasks = [
+        asyncio.ensure_future(run_chunk(start, items[start:start + size]))
+        for start in range(0, len(items), size)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for item in await next_done:
+                yield item
+    finally:
+        # Client went away: don't keep workers busy for nobody.
+        for t in tasks:
+            t.cancel()
+
+
+async def stream_zip(batcher, items, task, instruction, params=None, output=None):
+    buffer = _ChunkBuffer()
+    used = set()
+    ext = OUTPUT_FORMATS[output_options(output)["format"]][0]
+    # Every output format is already compressed, storing avoids compressing twice.
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        async for index, filename, result in _completed(batcher, items, task, instruction, params, output):
+            if isinstance(result, Exception):
+                log.warning("Item %d (%s) failed: %s", index, filename, result)
+                zf.writestr(_output_name(filename, index, used, "error.txt"), str(result))
+            else:
+                zf.writestr(_output_name(filename, index, used, ext), result)
+            yield buffer.drain()
+    # Central directory is written on close
+    yield buffer.drain()
+
+
+async def stream_ndjson(batcher, items, task, instruction, params=None, output=None):
+    media_type = OUTPUT_FORMATS[output_options(output)["format"]][1]
+    async for index, filename, result in _completed(batcher, items, task, instruction, params, output):
+        if isinstance(result, Exception):
+            log.warning("Item %d (%s) failed: %s", index, filename, result)
+            item = {"index": index, "filename": filename, "status": "error", "error": str(result)}
+        else:
+            item = {
+                "index": index,
+                "filename": filename,
+                "status": "ok",
+                "media_type": media_type,
+                "data": base64.b64encode(result).decode("ascii"),
+            }
+        yield (json.dumps(item) + "\n").encode("utf-8")
+
+
+def variant_files(results):
+    """[(name, media_type, bytes)] from process_variants -> ZIP archive bytes."""
+    extensions = {media_type: ext for ext, media_type in OUTPUT_FORMATS.values()}
+    buffer = io.BytesIO()
+    used = set()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for index, (name, media_type, data) in enumerate(results):
+            filename = f"{name}.{extensions[media_type]}"
+            if filename in used:
+                filename = f"{name}-{index + 1}.{extensions[media_type]}"
+            used.add(filename)
+            zf.writestr(filename, data)
+    return buffer.getvalue()
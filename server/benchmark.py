@@ -0,0 +1,757 @@
+"""
+Engine microbenchmarks. Run from server/:
+    python benchmark.py coarse-mask --size 1500 --runs 10 --output coarse.json
+Results are printed as JSON so runs can be diffed.
+
+`suite` is the regression run: every task and stage on 1, 12 and 24 MP inputs
+with and without alpha, plus throughput per worker count and peak RSS.
+--stub-model swaps the network for a deterministic threshold so it runs offline:
+    python benchmark.py suite --stub-model --runs 5 --output suite.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from engine import BatchBGEngine, ResultCache
+
+
+def synthetic_product(width, height, seed=0):
+    """Deterministic 'product shot': dark rounded object on a soft grey gradient with sensor noise."""
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(200, 245, height, dtype=np.float32)[:, None, None]
+    img = np.broadcast_to(gradient, (height, width, 3)).copy()
+
+    center = (width // 2, height // 2)
+    axes = (int(width * 0.3), int(height * 0.35))
+    cv2.ellipse(img, center, axes, 0, 0, 360, (40, 35, 30), -1)
+    cv2.rectangle(img, (center[0] - axes[0] // 2, center[1] - 10), (center[0] + axes[0] // 2, center[1] + 10), (90, 90, 95), -1)
+
+    img += rng.normal(0, 3, img.shape).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def time_calls(fn, runs, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def peak_allocation_mb(fn):
+    # numpy (and OpenCV outputs, which are numpy arrays) report to tracemalloc
+    tracemalloc.start()
+    try:
+        fn()
+        return round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(samples):
+    ms = np.array(samples) * 1000
+    return {
+        "runs": len(samples),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+    }
+
+
+def mask_iou(a, b, threshold=127):
+    a, b = a > threshold, b > threshold
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+_rembg_sessions = {}
+
+
+def legacy_rembg_mask(engine, img_bgr):
+    # The pre-direct path: PNG encode -> rembg.remove -> PNG decode -> alpha channel.
+    from rembg import new_session, remove
+    if engine.model_name not in _rembg_sessions:
+        _rembg_sessions[engine.model_name] = new_session(engine.model_name)
+    encoded = cv2.imencode('.png', img_bgr)[1].tobytes()
+    output = cv2.imdecode(np.frombuffer(remove(encoded, session=_rembg_sessions[engine.model_name]), np.uint8), cv2.IMREAD_UNCHANGED)
+    return output[:, :, 3]
+
+
+def bench_coarse_mask(args):
+    engine = BatchBGEngine()
+    img = synthetic_product(args.size, int(args.size * 0.75))
+
+    legacy = time_calls(lambda: legacy_rembg_mask(engine, img), args.runs)
+    direct = time_calls(lambda: engine.coarse_masks([img]), args.runs)
+
+    return {
+        "benchmark": "coarse-mask",
+        "input": f"{img.shape[1]}x{img.shape[0]}",
+        "legacy_png_roundtrip": summarize(legacy),
+        "direct_ndarray": summarize(direct),
+        "mask_iou": round(mask_iou(legacy_rembg_mask(engine, img), engine.coarse_masks([img])[0]), 4),
+    }
+
+
+def bench_edits(args):
+    engine = BatchBGEngine()
+    img = synthetic_product(args.size, int(args.size * 0.75))
+    stacked = "brightness:1.2;saturation:0.9;contrast:1.1"
+
+    def one_request_per_op():
+        # What the client used to do: one decode/convert/encode cycle per adjustment
+        current = img
+        for op in stacked.split(";"):
+            encoded = engine._encode_result(engine.apply_edits(current, op))
+            current = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_UNCHANGED)
+
+    return {
+        "benchmark": "edits",
+        "input": f"{img.shape[1]}x{img.shape[0]}",
+        "single_op": summarize(time_calls(lambda: engine._encode_result(engine.apply_edits(img, "brightness:1.2")), args.runs)),
+        "three_ops_fused": summarize(time_calls(lambda: engine._encode_result(engine.apply_edits(img, stacked)), args.runs)),
+        "three_ops_one_request_each": summarize(time_calls(one_request_per_op, args.runs)),
+    }
+
+
+def legacy_layout_composite(resized, target_size=2048):
+    # The per-channel float64 loop layout_on_white used before the compositing kernels
+    canvas = np.full((target_size, target_size, 3), 255, dtype=np.uint8)
+    new_h, new_w = resized.shape[:2]
+    start_x, start_y = (target_size - new_w) // 2, (target_size - new_h) // 2
+    fg_alpha = resized[:, :, 3] / 255.0
+    fg_color = resized[:, :, 0:3]
+    bg_slice = canvas[start_y:start_y + new_h, start_x:start_x + new_w]
+    for c in range(3):
+        bg_slice[:, :, c] = (fg_color[:, :, c] * fg_alpha + bg_slice[:, :, c] * (1 - fg_alpha))
+    return canvas
+
+
+def kernel_layout_composite(resized, target_size=2048):
+    from compositing import solid_canvas, blend_over
+    canvas = solid_canvas(target_size, target_size)
+    new_h, new_w = resized.shape[:2]
+    start_x, start_y = (target_size - new_w) // 2, (target_size - new_h) // 2
+    blend_over(canvas[start_y:start_y + new_h, start_x:start_x + new_w], resized[:, :, :3], np.ascontiguousarray(resized[:, :, 3]))
+    return canvas
+
+
+def legacy_shadow_composite(img_bgr, mask, shadow_alpha):
+    h, w = mask.shape
+    canvas = np.full((h, w, 3), 255, dtype=np.uint8)
+    s_alpha = shadow_alpha / 255.0
+    s_color = np.zeros((h, w, 3), dtype=np.uint8)
+    for c in range(3):
+        canvas[:, :, c] = (s_color[:, :, c] * s_alpha + canvas[:, :, c] * (1 - s_alpha))
+    obj_mask = (mask > 0).astype(np.uint8)
+    for c in range(3):
+        canvas[:, :, c] = img_bgr[:, :, c] * obj_mask + canvas[:, :, c] * (1 - obj_mask)
+    return canvas
+
+
+def kernel_shadow_composite(img_bgr, mask, shadow_alpha):
+    from compositing import solid_canvas, blend_color, paste_where
+    canvas = solid_canvas(*mask.shape)
+    blend_color(canvas, (0, 0, 0), shadow_alpha)
+    return paste_where(canvas, img_bgr, mask)
+
+
+def bench_compositing(args):
+    # Foreground as layout_on_white sees it: 80% of the 2048 canvas, with a soft alpha edge
+    side = int(2048 * 0.8)
+    fg = synthetic_product(side, int(side * 0.75))
+    alpha = np.zeros(fg.shape[:2], dtype=np.uint8)
+    cv2.ellipse(alpha, (fg.shape[1] // 2, fg.shape[0] // 2), (int(side * 0.3), int(side * 0.27)), 0, 0, 360, 255, -1)
+    alpha = cv2.GaussianBlur(alpha, (15, 15), 0)
+    resized = np.dstack([fg, alpha])
+
+    shadow_alpha = cv2.GaussianBlur(alpha, (31, 31), 0) // 3
+
+    result = {"benchmark": "compositing", "foreground": f"{fg.shape[1]}x{fg.shape[0]}"}
+    for name, fn in [
+        ("layout_legacy", lambda: legacy_layout_composite(resized)),
+        ("layout_kernel", lambda: kernel_layout_composite(resized)),
+        ("shadow_legacy", lambda: legacy_shadow_composite(fg, alpha, shadow_alpha)),
+        ("shadow_kernel", lambda: kernel_shadow_composite(fg, alpha, shadow_alpha)),
+    ]:
+        result[name] = summarize(time_calls(fn, args.runs))
+        result[name]["peak_alloc_mb"] = peak_allocation_mb(fn)
+    return result
+
+
+def legacy_shadow_alpha(mask):
+    # Full-resolution blur and an affine warp for the offset, as shadow_alpha did before
+    h, w = mask.shape
+    shadow = cv2.multiply(cv2.GaussianBlur(mask, (31, 31), 0), 0.3)
+    return cv2.warpAffine(shadow, np.float32([[1, 0, 20], [0, 1, 20]]), (w, h))
+
+
+def bench_shadow(args):
+    # Shadow layer of a 2048 catalog canvas (or --size): cold, and re-rendered from the cache
+    side = args.size
+    _, alpha = dark_product_with_matte(side, side, 0.8)
+    mask = cv2.threshold(alpha, 10, 255, cv2.THRESH_BINARY)[1]
+    cold = BatchBGEngine(cache=ResultCache(max_bytes=0))
+    warm = BatchBGEngine()
+    warm.shadow_alpha(mask)
+    reference = legacy_shadow_alpha(mask)
+
+    result = {"benchmark": "shadow", "input": f"{side}x{side}"}
+    for name, fn in [
+        ("legacy_full_resolution", lambda: legacy_shadow_alpha(mask)),
+        ("reduced_resolution", lambda: cold.shadow_alpha(mask)),
+        ("cached_new_opacity", lambda: warm.shadow_alpha(mask, {"opacity": 0.5})),
+    ]:
+        result[name] = summarize(time_calls(fn, args.runs))
+        result[name]["peak_alloc_mb"] = peak_allocation_mb(fn)
+    diff = np.abs(cold.shadow_alpha(mask).astype(np.int16) - reference)
+    result["max_abs_diff"] = int(diff.max())
+    result["mean_abs_diff"] = round(float(diff.mean()), 4)
+    return result
+
+
+def legacy_gray_guided_filter(I, p, r, eps):
+    # Full-frame, grayscale-guide filter the engine used before the colour version
+    h, w = p.shape[:2]
+    h_s, w_s = int(h / 2), int(w / 2)
+    I_sub = cv2.resize(I, (w_s, h_s), interpolation=cv2.INTER_NEAREST)
+    p_sub = cv2.resize(p, (w_s, h_s), interpolation=cv2.INTER_NEAREST)
+    r_sub = int(r / 2)
+    I_gray_sub = cv2.cvtColor(I_sub, cv2.COLOR_BGR2GRAY)
+    mean_I = cv2.boxFilter(I_gray_sub, cv2.CV_32F, (r_sub, r_sub))
+    mean_p = cv2.boxFilter(p_sub, cv2.CV_32F, (r_sub, r_sub))
+    mean_Ip = cv2.boxFilter(I_gray_sub * p_sub, cv2.CV_32F, (r_sub, r_sub))
+    mean_II = cv2.boxFilter(I_gray_sub * I_gray_sub, cv2.CV_32F, (r_sub, r_sub))
+    a = (mean_Ip - mean_I * mean_p) / (mean_II - mean_I * mean_I + eps)
+    b = mean_p - a * mean_I
+    mean_a = cv2.resize(cv2.boxFilter(a, cv2.CV_32F, (r_sub, r_sub)), (w, h), interpolation=cv2.INTER_LINEAR)
+    mean_b = cv2.resize(cv2.boxFilter(b, cv2.CV_32F, (r_sub, r_sub)), (w, h), interpolation=cv2.INTER_LINEAR)
+    return mean_a * cv2.cvtColor(I, cv2.COLOR_BGR2GRAY) + mean_b
+
+
+def _full_frame(mask, origin, size):
+    # refine_alpha hands over ROI crops: paste them back into a zero frame
+    (ox, oy), (w, h) = origin, size
+    frame = np.zeros((h, w), dtype=mask.dtype)
+    frame[oy:oy + mask.shape[0], ox:ox + mask.shape[1]] = mask
+    return frame
+
+
+def legacy_refine_unknown_band(src_bgr, coarse_alpha, unknown_mask, core_mask, out, radius, eps,
+                               origin=(0, 0), mask_size=None, **_):
+    size = mask_size or (unknown_mask.shape[1], unknown_mask.shape[0])
+    coarse_alpha, unknown_mask, core_mask = (_full_frame(m, origin, size) for m in (coarse_alpha, unknown_mask, core_mask))
+    guide = src_bgr.astype(np.float32) / 255.0
+    q = legacy_gray_guided_filter(guide, coarse_alpha.astype(np.float32) / 255.0, radius, eps)
+    out[:] = core_mask
+    np.copyto(out, np.clip(q * 255, 0, 255).astype(np.uint8), where=unknown_mask > 0)
+    return out
+
+
+def dark_product_with_matte(width, height, subject=1.0):
+    """Dark product on a dark background plus its ground-truth (anti-aliased) alpha.
+    `subject` scales the product relative to the frame (1.0 fills ~60% of it)."""
+    scale = 4
+    big = np.zeros((height * scale, width * scale), dtype=np.uint8)
+    center = (width * scale // 2, height * scale // 2)
+    axes = (int(width * scale * 0.3 * subject), int(height * scale * 0.35 * subject))
+    cv2.ellipse(big, center, axes, 0, 0, 360, 255, -1)
+    bar = int(width * scale * subject) // 3
+    cv2.rectangle(big, (center[0] - bar, center[1] - 8 * scale), (center[0] + bar, center[1] + 8 * scale), 255, -1)
+    gt_alpha = cv2.resize(big, (width, height), interpolation=cv2.INTER_AREA)
+
+    rng = np.random.default_rng(1)
+    background = np.empty((height, width, 3), dtype=np.float32)
+    background[:] = np.linspace(70, 95, width, dtype=np.float32)[None, :, None] * np.float32([1.0, 0.95, 0.9])
+    product = np.empty_like(background)
+    product[:] = (30, 28, 40)
+    a = gt_alpha[:, :, None].astype(np.float32) / 255.0
+    img = product * a + background * (1 - a) + rng.normal(0, 2, background.shape).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8), gt_alpha
+
+
+def bench_guided_filter(args):
+    from engine import DEFAULT_MATTING_PARAMS
+    engine = BatchBGEngine()
+    original = engine.refine_unknown_band
+    variants = [("legacy_gray_full_frame", legacy_refine_unknown_band), ("color_tiled", original)]
+    result = {"benchmark": "guided-filter"}
+
+    for subject in (1.0, 0.3):
+        img, gt_alpha = dark_product_with_matte(args.size, int(args.size * 0.75), subject)
+        # Simulated network output: right shape, sloppy edge
+        coarse = cv2.GaussianBlur(cv2.dilate(gt_alpha, np.ones((5, 5), np.uint8)), (15, 15), 0)
+        band = cv2.dilate(gt_alpha, np.ones((25, 25), np.uint8)) != cv2.erode(gt_alpha, np.ones((25, 25), np.uint8))
+        guide, p = img.astype(np.float32) / 255.0, coarse.astype(np.float32) / 255.0
+        filters = {"legacy_gray_full_frame": legacy_gray_guided_filter, "color_tiled": engine.fast_guided_filter}
+
+        for name, refine in variants:
+            # Whole refine_alpha stage (morphology + trimap + filter)
+            engine.refine_unknown_band = refine
+            fn = lambda: engine.refine_alpha(img, coarse, DEFAULT_MATTING_PARAMS)
+            entry = summarize(time_calls(fn, args.runs))
+            entry["peak_alloc_mb"] = peak_allocation_mb(fn)
+            # Filter quality on its own, against the ground-truth matte
+            q = np.clip(filters[name](guide, p, 20, 1e-6) * 255, 0, 255)
+            entry["edge_mae"] = round(float(np.abs(q[band] - gt_alpha[band]).mean()), 2)
+            result[f"{name}_subject_{subject}"] = entry
+        engine.refine_unknown_band = original
+
+    result["input"] = f"{img.shape[1]}x{img.shape[0]}"
+    return result
+
+
+def bench_resolution(args):
+    # Meant for large originals, e.g. --size 6000; at or below the working size both modes match
+    from engine import DEFAULT_MATTING_PARAMS
+    engine = BatchBGEngine()
+    original, gt_alpha = dark_product_with_matte(args.size, int(args.size * 0.75))
+    work = engine._downscale(original, engine.work_dim)
+    # Stand-in for the network: the true matte at working size, so no overshoot is needed
+    coarse = engine._downscale(gt_alpha, engine.work_dim)
+    params = dict(DEFAULT_MATTING_PARAMS, threshold=127, dilate_iterations=0)
+    h, w = gt_alpha.shape
+    band = cv2.dilate(gt_alpha, np.ones((9, 9), np.uint8)) != cv2.erode(gt_alpha, np.ones((9, 9), np.uint8))
+
+    result = {"benchmark": "resolution", "input": f"{w}x{h}", "working": f"{work.shape[1]}x{work.shape[0]}"}
+    for name, img in (("working_resolution", work), ("full_resolution", original)):
+        fn = lambda: engine.guided_matting_pipeline(img, coarse_alpha=coarse, params=params)
+        entry = summarize(time_calls(fn, args.runs))
+        entry["peak_alloc_mb"] = peak_allocation_mb(fn)
+        # Edge fidelity at the original size (the working alpha is upscaled to compare)
+        alpha = engine.refine_alpha(img, coarse, params)
+        if alpha.shape != (h, w):
+            alpha = cv2.resize(alpha, (w, h), interpolation=cv2.INTER_LINEAR)
+        entry["edge_mae"] = round(float(np.abs(alpha[band].astype(np.int16) - gt_alpha[band]).mean()), 2)
+        result[name] = entry
+    return result
+
+
+def legacy_full_frame_matting(engine, img_bgr, coarse_alpha, params):
+    """Pre-ROI refine_alpha + composite: morphology, trimap and the RGBA merge over the whole frame."""
+    _, solid = cv2.threshold(coarse_alpha, params["threshold"], 255, cv2.THRESH_BINARY)
+    close_size = params["close_kernel"]
+    solid = cv2.morphologyEx(solid, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (close_size, close_size)))
+    solid = cv2.dilate(solid, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)), iterations=params["dilate_iterations"])
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (params["trimap_kernel"],) * 2)
+    eroded = cv2.erode(solid, kernel, iterations=2)
+    unknown = cv2.bitwise_xor(cv2.dilate(solid, kernel, iterations=1), eroded)
+    alpha = np.empty(img_bgr.shape[:2], dtype=np.uint8)
+    engine.refine_unknown_band(
+        img_bgr, solid, unknown, eroded, alpha, radius=params["gf_radius"], eps=params["gf_eps"],
+        subsample=params["gf_subsample"], tile=params["gf_tile"],
+    )
+    return engine.layout_array(cv2.merge([*cv2.split(img_bgr), alpha]))
+
+
+def bench_roi(args):
+    # Small products on large frames are where the subject ROI pays off
+    from engine import DEFAULT_MATTING_PARAMS
+    engine = BatchBGEngine()
+    params = DEFAULT_MATTING_PARAMS
+    result = {"benchmark": "roi"}
+    for subject in (1.0, 0.5, 0.25, 0.1):
+        img, gt_alpha = dark_product_with_matte(args.size, int(args.size * 0.75), subject)
+        coarse = cv2.GaussianBlur(cv2.dilate(gt_alpha, np.ones((5, 5), np.uint8)), (15, 15), 0)
+        variants = {
+            "full_frame": lambda: legacy_full_frame_matting(engine, img, coarse, params),
+            "subject_roi": lambda: engine.matting_array(img, coarse, params),
+        }
+        entry = {"area_ratio": round(cv2.countNonZero(gt_alpha) / gt_alpha.size, 3)}
+        for name, fn in variants.items():
+            entry[name] = summarize(time_calls(fn, args.runs))
+            entry[name]["peak_alloc_mb"] = peak_allocation_mb(fn)
+        entry["identical"] = bool(np.array_equal(variants["full_frame"](), variants["subject_roi"]()))
+        result[f"subject_{subject}"] = entry
+    result["input"] = f"{img.shape[1]}x{img.shape[0]}"
+    return result
+
+
+def bench_decode(args):
+    # Meant for large JPEGs, e.g. --size 8000 (48 MP)
+    engine = BatchBGEngine()
+    img = synthetic_product(args.size, int(args.size * 0.75))
+    encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()
+    del img
+
+    def legacy_decode():
+        # Full-size decode, then downscale
+        full = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_UNCHANGED)
+        return engine._downscale(full, engine.work_dim)
+
+    result = {"benchmark": "decode", "input": f"{args.size}x{int(args.size * 0.75)} JPEG, {len(encoded) // 1024} KB"}
+    for name, fn in (("full_decode_then_resize", legacy_decode), ("dct_scaled_decode", lambda: engine.decode_image(encoded))):
+        entry = summarize(time_calls(fn, args.runs))
+        entry["peak_alloc_mb"] = peak_allocation_mb(fn)
+        result[name] = entry
+    reference, reduced = legacy_decode(), engine.decode_image(encoded)
+    result["output"] = f"{reduced.shape[1]}x{reduced.shape[0]}"
+    result["mean_abs_diff"] = round(float(np.abs(reference.astype(np.int16) - reduced).mean()), 3)
+    return result
+
+
+def bench_encode(args):
+    from engine import output_options
+    engine = BatchBGEngine()
+    # The catalog shot: product laid out on the 2048x2048 white canvas
+    img = synthetic_product(args.size, int(args.size * 0.75))
+    alpha = np.zeros(img.shape[:2], dtype=np.uint8)
+    cv2.ellipse(alpha, (img.shape[1] // 2, img.shape[0] // 2), (int(img.shape[1] * 0.3), int(img.shape[0] * 0.35)), 0, 0, 360, 255, -1)
+    canvas = engine.layout_array(cv2.merge([*cv2.split(img), alpha]))
+
+    variants = {
+        "png_default": {},
+        "png_compression_1": {"compression": 1},
+        "png_compression_6": {"compression": 6},
+        "jpeg_90": {"format": "jpeg", "quality": 90},
+        "webp_80": {"format": "webp", "quality": 80},
+        "preview": {"preview": True},
+    }
+    result = {"benchmark": "encode", "input": f"{canvas.shape[1]}x{canvas.shape[0]}"}
+    for name, output in variants.items():
+        output = output_options(output)
+        entry = summarize(time_calls(lambda: engine._encode_result(canvas, output), args.runs))
+        entry["kb"] = len(engine._encode_result(canvas, output)) // 1024
+        result[name] = entry
+    return result
+
+
+def bench_models(args):
+    # Quality tiers (and the quantized copy of the full model, if prepared) against the full model
+    from models import MODEL_TIERS, QUANTIZED_SUFFIX, model_path, session_options
+    engine = BatchBGEngine()
+    img = synthetic_product(args.size, int(args.size * 0.75))
+    full_model = MODEL_TIERS["high"]
+    reference = engine.coarse_masks([img], full_model)[0]
+    opts = session_options()
+
+    result = {
+        "benchmark": "models",
+        "input": f"{img.shape[1]}x{img.shape[0]}",
+        "session": {
+            "intra_threads": opts.intra_op_num_threads,
+            "inter_threads": opts.inter_op_num_threads,
+            "opt_level": str(opts.graph_optimization_level),
+            "arena": opts.enable_cpu_mem_arena,
+            "execution_mode": str(opts.execution_mode),
+        },
+    }
+    for model_name in dict.fromkeys([full_model, full_model + QUANTIZED_SUFFIX, *MODEL_TIERS.values()]):
+        try:
+            path = model_path(model_name)
+        except (FileNotFoundError, ValueError) as e:
+            result[model_name] = {"skipped": str(e)}
+            continue
+        entry = summarize(time_calls(lambda: engine.coarse_masks([img], model_name), args.runs))
+        entry["mask_iou"] = round(mask_iou(reference, engine.coarse_masks([img], model_name)[0]), 4)
+        entry["model_mb"] = round(os.path.getsize(path) / (1024 * 1024), 1)
+        result[model_name] = entry
+    return result
+
+
+class StubMaskEngine(BatchBGEngine):
+    """Engine whose 'network' is a grey-level threshold at the model's input size:
+    no model file or ONNX session, same mask shape and soft upscaled edge."""
+
+    def _get_session(self, model_name=None):
+        raise RuntimeError("StubMaskEngine has no ONNX session")
+
+    def coarse_masks(self, images_bgr, model_name=None):
+        from instrumentation import stage
+        from models import model_spec
+        size = model_spec(model_name or self.model_name)["size"]
+        masks = []
+        with stage("inference"):
+            for img in images_bgr:
+                small = cv2.cvtColor(cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+                _, mask = cv2.threshold(small, 128, 255, cv2.THRESH_BINARY_INV)
+                masks.append(cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_LINEAR))
+        return masks
+
+
+def suite_engine(args):
+    # No result cache: every run does the full work
+    cls = StubMaskEngine if args.stub_model else BatchBGEngine
+    return cls(cache=ResultCache(max_bytes=0))
+
+
+SUITE_RESOLUTIONS = {"1mp": (1152, 864), "12mp": (4000, 3000), "24mp": (6000, 4000)}
+
+SUITE_TASKS = {
+    "remove_bg": ("REMOVE_BG", None),
+    "edit": ("EDIT", "brightness:1.2;contrast:1.1;saturation:0.9"),
+}
+
+
+def suite_input(width, height, alpha):
+    """Encoded upload: JPEG for opaque shots, PNG with a transparent background otherwise."""
+    img = synthetic_product(width, height)
+    if not alpha:
+        return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()
+    a = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(a, (width // 2, height // 2), (int(width * 0.35), int(height * 0.4)), 0, 0, 360, 255, -1)
+    return cv2.imencode(".png", np.dstack([img, a]))[1].tobytes()
+
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets VmHWM, so each case reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # Elsewhere only the process-wide peak is available (kB on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+def stage_breakdown(runs):
+    """p50/p95 per stage over several collect() runs; repeated stages within a run are summed."""
+    per_stage = {}
+    for stages in runs:
+        totals = {}
+        for name, seconds in stages:
+            totals[name] = totals.get(name, 0.0) + seconds
+        for name, seconds in totals.items():
+            per_stage.setdefault(name, []).append(seconds)
+    return {name: summarize(samples) for name, samples in per_stage.items()}
+
+
+def throughput(args, contents, task, instruction, workers):
+    """Images/sec with `workers` threads, each owning an engine as in the server's thread mode."""
+    local = threading.local()
+
+    def job(_):
+        if not hasattr(local, "engine"):
+            local.engine = suite_engine(args)
+        local.engine.process_image(contents, task=task, instruction=instruction)
+
+    jobs = args.runs * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # One job per worker first, so session creation is not timed
+        list(executor.map(job, range(workers)))
+        start = time.perf_counter()
+        list(executor.map(job, range(jobs)))
+        elapsed = time.perf_counter() - start
+    return {"workers": workers, "images": jobs, "images_per_sec": round(jobs / elapsed, 2)}
+
+
+def bench_suite(args):
+    import cv2 as _cv2
+    import onnxruntime
+    from instrumentation import collect
+    engine = suite_engine(args)
+
+    result = {
+        "benchmark": "suite",
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": _cv2.__version__,
+            "onnxruntime": onnxruntime.__version__,
+            "model": "stub" if args.stub_model else engine.model_name,
+        },
+        "runs": args.runs,
+        "cases": {},
+    }
+    for res_name, (width, height) in SUITE_RESOLUTIONS.items():
+        if res_name not in args.resolutions:
+            continue
+        for alpha in (False, True):
+            contents = suite_input(width, height, alpha)
+            for task_name, (task, instruction) in SUITE_TASKS.items():
+                fn = lambda: collect(engine.process_image, contents, task=task, instruction=instruction)[1]
+                _reset_peak_rss()
+                fn()
+                stages, samples = [], []
+                for _ in range(args.runs):
+                    start = time.perf_counter()
+                    stages.append(fn())
+                    samples.append(time.perf_counter() - start)
+                case = summarize(samples)
+                case["input_kb"] = len(contents) // 1024
+                case["peak_rss_mb"] = peak_rss_mb()
+                case["stages"] = stage_breakdown(stages)
+                result["cases"][f"{task_name}/{res_name}/{'alpha' if alpha else 'opaque'}"] = case
+
+    # Stages on their own, on a 12 MP decode at the working size
+    img = engine.decode_image(suite_input(*SUITE_RESOLUTIONS["12mp"], alpha=False))
+    rgba = np.dstack([img, engine.coarse_masks([img])[0]])
+    guide = img.astype(np.float32) / 255.0
+    p = rgba[:, :, 3].astype(np.float32) / 255.0
+    result["stages"] = {
+        "fast_guided_filter": summarize(time_calls(lambda: engine.fast_guided_filter(guide, p, 20, 1e-6), args.runs)),
+        "layout_on_white": summarize(time_calls(lambda: engine.layout_on_white(rgba), args.runs)),
+    }
+
+    contents = suite_input(*SUITE_RESOLUTIONS["12mp"], alpha=False)
+    result["throughput"] = {
+        task_name: [throughput(args, contents, task, instruction, n) for n in args.workers]
+        for task_name, (task, instruction) in SUITE_TASKS.items()
+    }
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+
+# Imported at server start only by the workers, in the background (see workers.py)
+HEAVY_MODULES = ("engine", "cv2", "numpy", "onnxruntime", "PIL")
+
+
+def import_breakdown(env):
+    """Cumulative import time (seconds) of `main` and of each module it imports directly,
+    parsed from `python -X importtime`; plus the HEAVY_MODULES that got imported."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True,
+    ).stderr
+    children, imported, breakdown = [], set(), {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        imported.add(name.split(".")[0])
+        if depth == 1:
+            children.append((name, int(cumulative) / 1e6))
+        elif depth == 0:
+            if name == "main":
+                breakdown = dict(children, main=int(cumulative) / 1e6)
+            children = []
+    return breakdown, sorted(m for m in HEAVY_MODULES if m in imported)
+
+
+def bench_startup(args):
+    # What the Electron-spawned backend pays before it can answer. `heavy_imports`
+    # must stay empty: cv2/numpy/onnxruntime load in the background workers.
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, BATCHBG_JOBS_DB=os.path.join(tmp, "jobs.sqlite3"), BATCHBG_PRELOAD="0")
+    runs = [import_breakdown(env) for _ in range(args.runs)]
+    heavy = runs[-1][1]
+    modules = {name for breakdown, _ in runs for name in breakdown}
+    imports = {
+        name: summarize([breakdown.get(name, 0.0) for breakdown, _ in runs])["p50_ms"] for name in modules
+    }
+
+    bind_samples, health_samples = [], []
+    for _ in range(args.runs):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "main.py"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(env, BATCHBG_HOST="127.0.0.1", BATCHBG_PORT=str(port)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if server.poll() is not None:
+                        raise RuntimeError("Server exited during start-up")
+                    time.sleep(0.002)
+            bind_samples.append(time.perf_counter() - start)
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=30).read()
+            health_samples.append(time.perf_counter() - start)
+        finally:
+            server.terminate()
+            server.wait()
+
+    first_health = summarize(health_samples)
+    # Regressions that make the run exit non-zero, so CI can gate on it
+    failures = []
+    if heavy:
+        failures.append(f"heavy modules imported at start-up: {', '.join(heavy)}")
+    if first_health["p50_ms"] > args.max_first_health_ms:
+        failures.append(f"first /health p50 {first_health['p50_ms']} ms > {args.max_first_health_ms} ms")
+
+    return {
+        "benchmark": "startup",
+        "python": platform.python_version(),
+        "bind": summarize(bind_samples),
+        "first_health": first_health,
+        "import_main_ms": imports.pop("main"),
+        # Direct imports of main.py, slowest first (p50 of -X importtime cumulative)
+        "imports_ms": dict(sorted(imports.items(), key=lambda item: -item[1])),
+        "heavy_imports": heavy,
+        "failures": failures,
+    }
+
+
+BENCHMARKS = {
+    "coarse-mask": bench_coarse_mask,
+    "edits": bench_edits,
+    "compositing": bench_compositing,
+    "guided-filter": bench_guided_filter,
+    "resolution": bench_resolution,
+    "shadow": bench_shadow,
+    "roi": bench_roi,
+    "decode": bench_decode,
+    "encode": bench_encode,
+    "models": bench_models,
+    "suite": bench_suite,
+    "startup": bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BatchBG engine benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--size", type=int, default=1500, help="Long side of the synthetic input")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--output", help="Also write the JSON result to this file")
+    parser.add_argument("--stub-model", action="store_true", help="suite: threshold stand-in for the network (offline)")
+    parser.add_argument("--workers", type=lambda v: [int(n) for n in v.split(",")], default=[1, 2, 4],
+                        help="suite: worker counts for the throughput runs, e.g. 1,2,4")
+    parser.add_argument("--resolutions", type=lambda v: v.split(","), default=list(SUITE_RESOLUTIONS),
+                        help="suite: subset of " + ",".join(SUITE_RESOLUTIONS))
+    parser.add_argument("--max-first-health-ms", type=float, default=1000,
+                        help="startup: fail when the p50 time to the first /health answer exceeds this")
+    args = parser.parse_args()
+
+    results = BENCHMARKS[args.benchmark](args)
+    result = json.dumps(results, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    if results.get("failures"):
+        sys.exit("\n".join(results["failures"]))
+
+
+if __name__ == "__main__":
+    main()
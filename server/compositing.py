@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+
+# Alpha compositing kernels shared by the layout, shadow and variant renderers.
+# Everything stays uint8: OpenCV's saturating multiply with scale=1/255 does the
+# weighting, results are written into `dst` in place (slices of a canvas work).
+
+_templates = {}
+_MAX_TEMPLATES = 8
+
+
+def solid_canvas(height, width, color=(255, 255, 255)):
+    """A fresh canvas filled with `color` (BGR), copied from a cached template."""
+    key = (height, width, tuple(color))
+    template = _templates.get(key)
+    if template is None:
+        template = np.full((height, width, 3), color, dtype=np.uint8)
+        template.flags.writeable = False
+        if len(_templates) < _MAX_TEMPLATES:
+            _templates[key] = template
+    return template.copy()
+
+
+def _alpha3(alpha):
+    return cv2.merge([alpha, alpha, alpha])
+
+
+def blend_over(dst, fg_bgr, alpha):
+    """dst = fg * a + dst * (1 - a), in place. dst/fg: uint8 HxWx3, alpha: uint8 HxW."""
+    alpha3 = _alpha3(alpha)
+    fg_part = cv2.multiply(np.ascontiguousarray(fg_bgr), alpha3, scale=1 / 255.0)
+    cv2.multiply(dst, cv2.bitwise_not(alpha3), dst=dst, scale=1 / 255.0)
+    cv2.add(dst, fg_part, dst=dst)
+    return dst
+
+
+def blend_color(dst, color, alpha):
+    """dst = color * a + dst * (1 - a), in place, for a solid colour layer such as a shadow."""
+    alpha3 = _alpha3(alpha)
+    cv2.multiply(dst, cv2.bitwise_not(alpha3), dst=dst, scale=1 / 255.0)
+    if any(color):
+        cv2.add(dst, cv2.multiply(alpha3, tuple(color) + (0,), scale=1 / 255.0), dst=dst)
+    return dst
+
+
+def paste_where(dst, fg_bgr, mask):
+    """dst = fg where mask is set, in place (hard-edged compositing)."""
+    cv2.copyTo(np.ascontiguousarray(fg_bgr), mask, dst)
+    return dst
+
+
+def shadow_under(fg_bgra, shadow_alpha):
+    """Black shadow layer under a transparent foreground, result still transparent:
+    alpha = a + s * (1 - a), colour = fg * a / alpha (straight alpha)."""
+    a = np.ascontiguousarray(fg_bgra[:, :, 3])
+    out_alpha = cv2.add(a, cv2.multiply(shadow_alpha, cv2.bitwise_not(a), scale=1 / 255.0))
+    # Share of each pixel's opacity that comes from the foreground
+    weight = cv2.divide(a, out_alpha, scale=255)
+    out = np.empty_like(fg_bgra)
+    out[:, :, :3] = cv2.multiply(np.ascontiguousarray(fg_bgra[:, :, :3]), _alpha3(weight), scale=1 / 255.0)
+    out[:, :, 3] = out_alpha
+    return out
@@ -1,67 +1,483 @@
 import cv2
 import numpy as np
-from rembg import remove, new_session
 from PIL import Image
 import io
+import math
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from compositing import solid_canvas, blend_over, blend_color, paste_where, shadow_under
+from instrumentation import stage
+from models import MODEL_TIERS, WARM_TIERS, create_session, model_spec
+from options import OUTPUT_FORMATS, output_options, shadow_options, variant_options
+from uploads import ImageTooLarge, content_hash
+
+log = logging.getLogger("batchbg.engine")
+
+# Tunable knobs of the matting pipeline. Requests may override any of them;
+# they are part of the cache key of every stage downstream of the coarse mask.
+DEFAULT_MATTING_PARAMS = {
+    "threshold": 1,          # coarse alpha > threshold counts as object
+    "close_kernel": 5,       # hole filling
+    "dilate_iterations": 2,  # overshoot to recover bitten dark edges
+    "trimap_kernel": 10,     # width of the unknown band
+    "gf_radius": 20,
+    "gf_eps": 1e-6,
+    "gf_subsample": 2,       # guided filter coefficients are computed at 1/s resolution
+    "gf_tile": 256,          # only tiles touching the unknown band are filtered
+    # Multi-resolution mode: network, morphology and trimap at the working size,
+    # edge band refined against the original pixels (up to BATCHBG_MAX_FULL_DIM)
+    "full_resolution": os.getenv("BATCHBG_FULL_RES", "0") == "1",
+    # Network tier (models.MODEL_TIERS): "high" or the faster, lighter "draft"
+    "quality": "high",
+}
+
+PREVIEW_DIM = int(os.getenv("BATCHBG_PREVIEW_DIM", 1024))
+
+
+class ResultCache:
+    """
+    Content-addressed LRU cache for pipeline stages (coarse mask, refined alpha,
+    encoded output). The memory tier is bounded by bytes; the optional disk tier
+    (a directory) survives restarts and is shared between worker processes.
+    Values are bytes or numpy arrays. Thread-safe.
+    """
+
+    def __init__(self, max_bytes=128 * 1024 * 1024, disk_dir=None, disk_max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_bytes=int(os.getenv("BATCHBG_CACHE_MB", 128)) * 1024 * 1024,
+            disk_dir=os.getenv("BATCHBG_CACHE_DIR") or None,
+            disk_max_bytes=int(os.getenv("BATCHBG_CACHE_DISK_MB", 1024)) * 1024 * 1024,
+        )
+
+    content_hash = staticmethod(content_hash)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _nbytes(value):
+        return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self._disk_get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._memory_put(key, value)
+        return value
+
+    def put(self, key, value):
+        if isinstance(value, np.ndarray):
+            # Shared between requests: nobody may modify it in place.
+            value.flags.writeable = False
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    def _memory_put(self, key, value):
+        size = self._nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._nbytes(self._entries.pop(key))
+            self._entries[key] = value
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self._nbytes(evicted)
+
+    def _disk_path(self, key, ext):
+        return os.path.join(self.disk_dir, f"{key}.{ext}")
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            npy = self._disk_path(key, "npy")
+            if os.path.exists(npy):
+                value = np.load(npy)
+                os.utime(npy)
+                return value
+            raw = self._disk_path(key, "bin")
+            if os.path.exists(raw):
+                with open(raw, "rb") as f:
+                    value = f.read()
+                os.utime(raw)
+                return value
+        except (OSError, ValueError) as e:
+            log.warning("Could not read %s from the disk cache: %s", key, e)
+        return None
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        try:
+            ext = "npy" if isinstance(value, np.ndarray) else "bin"
+            tmp = self._disk_path(key, ext + ".tmp")
+            with open(tmp, "wb") as f:
+                if ext == "npy":
+                    np.save(f, value)
+                else:
+                    f.write(value)
+            # Atomic so other worker processes never read a half-written entry
+            os.replace(tmp, self._disk_path(key, ext))
+            self._disk_evict()
+        except OSError as e:
+            log.warning("Could not write %s to the disk cache: %s", key, e)
+
+    def _disk_evict(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(self.disk_dir, name))
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        # Least recently used first (reads touch mtime)
+        for _, size, name in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            os.remove(os.path.join(self.disk_dir, name))
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+
+# One cache per process, shared by every engine (thread workers share it too).
+result_cache = ResultCache.from_env()
+
 
 class BatchBGEngine:
-    def __init__(self):
-        print("Initializing BatchBG Engine V3 (Matting Pipeline)...")
-        self.session = None
-
-    def _get_session(self):
-        if self.session is None:
-            print("Lazy loading 'isnet-general-use' model (High Quality)...")
-            self.session = new_session("isnet-general-use")
-        return self.session
-
-    def process_image(self, image_bytes, task="REMOVE_BG", instruction=None):
-        print(f"[Engine] Processing task: '{task}' with instruction: '{instruction}'")
-        
+    # Network of the default ("high") tier
+    model_name = MODEL_TIERS["high"]
+    # Long side of the working image. The pipeline's kernel sizes are tuned for it.
+    work_dim = int(os.getenv("BATCHBG_WORK_DIM", 1500))
+    # Long side cap for full-resolution refinement (memory safety)
+    max_full_dim = int(os.getenv("BATCHBG_MAX_FULL_DIM", 6000))
+    # Inputs above this are rejected from their header, before decoding
+    max_pixels = int(os.getenv("BATCHBG_MAX_PIXELS", 100_000_000))
+
+    def __init__(self, cache=None):
+        log.info("Initializing BatchBG Engine V3 (Matting Pipeline)")
+        self.sessions = {}
+        self.cache = cache if cache is not None else result_cache
+
+    def _get_session(self, model_name=None):
+        # Plain ONNX Runtime sessions, one per model: coarse_masks does rembg's
+        # pre/postprocessing itself
+        model_name = model_name or self.model_name
+        session = self.sessions.get(model_name)
+        if session is None:
+            log.info("Loading '%s' model", model_name)
+            session = self.sessions[model_name] = create_session(model_name)
+        return session
+
+    def warm_up(self):
+        """Load the models of WARM_TIERS and run one dummy inference on each, so the first
+        request doesn't pay for session creation and ONNX Runtime's first-run allocations."""
+        models = list(dict.fromkeys(MODEL_TIERS[tier] for tier in WARM_TIERS))
+        for model_name in models:
+            self.coarse_masks([np.zeros((64, 64, 3), dtype=np.uint8)], model_name)
+        log.info("%s warmed up", ", ".join(models))
+        return models
+
+    def decode_image(self, image_bytes, max_dim=None):
         # Decode input to BGR
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-        
-        if img is None:
-            print("[Engine] Error: Could not decode image")
-            raise ValueError("Could not decode image")
+        max_dim = max_dim or self.work_dim
+        with stage("decode"):
+            nparr = np.frombuffer(image_bytes, np.uint8)
+            img = cv2.imdecode(nparr, self._decode_flags(image_bytes, max_dim))
+
+            if img is None:
+                log.warning("Could not decode image")
+                raise ValueError("Could not decode image")
+
+            # Resize for performance (Matting is expensive)
+            # 1500 is a good balance for quality.
+            h, w = img.shape[:2]
+            if max(h, w) > max_dim:
+                img = self._downscale(img, max_dim)
+                log.debug("Resized input from %dx%d to %dx%d for memory safety", w, h, img.shape[1], img.shape[0])
+        return img
 
-        # Resize for performance (Matting is expensive)
-        # 1500 is a good balance for quality.
-        max_dim = 1500 
+    def _decode_flags(self, image_bytes, max_dim):
+        """
+        Read the header only: enforce the pixel cap, and for JPEGs well above max_dim
+        let libjpeg decode straight at 1/2, 1/4 or 1/8 scale from the DCT coefficients,
+        picking the smallest scale whose long side is still >= max_dim.
+        """
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as header:
+                fmt, (w, h) = header.format, header.size
+        except Image.DecompressionBombError:
+            raise ImageTooLarge(f"Image exceeds the {self.max_pixels} pixel limit")
+        except Exception:
+            # Unknown to PIL: let OpenCV try (and report) it
+            return cv2.IMREAD_UNCHANGED
+
+        if w * h > self.max_pixels:
+            raise ImageTooLarge(f"Image is {w}x{h}, above the {self.max_pixels} pixel limit")
+        if fmt == "JPEG":
+            for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                # libjpeg rounds scaled sizes up
+                if -(-max(w, h) // factor) >= max_dim:
+                    log.debug("Decoding %dx%d JPEG at 1/%d scale", w, h, factor)
+                    # Same orientation handling as IMREAD_UNCHANGED (EXIF ignored)
+                    return flag | cv2.IMREAD_IGNORE_ORIENTATION
+        return cv2.IMREAD_UNCHANGED
+
+    def _downscale(self, img, max_dim):
         h, w = img.shape[:2]
-        if max(h, w) > max_dim:
-            scale = max_dim / max(h, w)
-            new_w, new_h = int(w * scale), int(h * scale)
-            print(f"[Engine] Resizing input from {w}x{h} to {new_w}x{new_h} for memory safety")
-            img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+        if max(h, w) <= max_dim:
+            return img
+        scale = max_dim / max(h, w)
+        new_w, new_h = int(w * scale), int(h * scale)
+        return cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+    def _decode_dim(self, task, params):
+        # Only background removal benefits from the original pixels; edits stay at working size
+        if task == "REMOVE_BG" and params["full_resolution"]:
+            return self.max_full_dim
+        return self.work_dim
+
+    def process_image(self, image_bytes, task="REMOVE_BG", instruction=None, params=None, output=None):
+        log.debug("Processing task '%s' with instruction '%s'", task, instruction)
+        params = self._matting_params(params)
+        output = output_options(output)
 
+        # Identical request (same bytes, task, instruction, params, output): answer from cache.
+        # The decode size is part of the key: a held image (process_array) may differ.
+        with stage("hash"):
+            content_key = self.cache.content_hash(image_bytes)
+        output_key = self.cache.key("output", content_key, self._decode_dim(task, params), task, instruction, params, output)
+        cached = self.cache.get(output_key)
+        if cached is not None:
+            log.debug("Cache hit, returning stored result")
+            return cached
+
+        img = self.decode_image(image_bytes, self._decode_dim(task, params))
+        result = self._encode_result(self._run_task(img, task, instruction, params, content_key), output)
+        self.cache.put(output_key, result)
+        return result
+
+    def load_image(self, image_bytes):
+        """Decode once for the image store: returns (img, content_key)."""
+        return self.decode_image(image_bytes), self.cache.content_hash(image_bytes)
+
+    def process_array(self, img, content_key, task="REMOVE_BG", instruction=None, params=None, output=None, keep=False):
+        """
+        process_image for an image that is already decoded (held in the image store).
+        Returns (encoded_result, result_img); result_img is only returned when `keep`
+        is set, so the result can itself be held for the next edit. It is always the
+        full-quality result, whatever the output format.
+        """
+        params = self._matting_params(params)
+        output = output_options(output)
+        output_key = self.cache.key("output", content_key, img.shape[:2], task, instruction, params, output)
+        result = self.cache.get(output_key)
+        lossless = (output["format"] == "png" or output["lossless"]) and not output["preview"]
+
+        result_img = None
+        if result is None or (keep and not lossless):
+            result_img = self._run_task(img, task, instruction, params, content_key)
+            if result is None:
+                result = self._encode_result(result_img, output)
+                self.cache.put(output_key, result)
+
+        if not keep:
+            return result, None
+        if result_img is None:
+            # Decoding our own lossless output is far cheaper than re-running the task
+            result_img = cv2.imdecode(np.frombuffer(result, np.uint8), cv2.IMREAD_UNCHANGED)
+        return result, result_img
+
+    def encode_array(self, img, output=None):
+        """Encode a held image with the given output options."""
+        return self._encode_result(img, output)
+
+    def _run_task(self, img, task, instruction, params, content_key=None, coarse_alpha=None):
+        # Returns the result image; callers encode it with the requested output options
         if task == "REMOVE_BG":
-            return self.guided_matting_pipeline(img)
+            return self.matting_array(img, coarse_alpha=coarse_alpha, params=params, content_key=content_key)
             
         elif task == "EDIT":
-            print(f"[Engine] Applying edit: {instruction}")
-            if instruction.startswith("brightness"):
-                return self.adjust_brightness(img, instruction_val=instruction)
-            elif instruction.startswith("saturation"):
-                return self.adjust_saturation(img, instruction_val=instruction)
-            elif instruction.startswith("contrast"):
-                return self.adjust_contrast(img, instruction_val=instruction)
-            elif instruction == "shadow":
-                return self.add_shadow(img)
+            log.debug("Applying edit: %s", instruction)
+            with stage("edit"):
+                return self.apply_edits(img, instruction)
+
+        log.warning("No matching task '%s', returning original", task)
+        return img
+
+    def _matting_params(self, params):
+        merged = dict(DEFAULT_MATTING_PARAMS)
+        if params:
+            unknown = set(params) - set(merged)
+            if unknown:
+                raise ValueError(f"Unknown pipeline parameters: {sorted(unknown)}")
+            merged.update(params)
+        if merged["quality"] not in MODEL_TIERS:
+            raise ValueError(f"Unknown quality tier: {merged['quality']}")
+        return merged
+
+    def process_many(self, images_bytes, task="REMOVE_BG", instruction=None, params=None, output=None, max_batch=4):
+        """
+        Batched counterpart of process_image.
+        For REMOVE_BG the coarse masks of up to `max_batch` images come out of a single
+        session.run; the rest of the pipeline still runs per image.
+        Returns one entry per input: the encoded result, or the Exception that item raised.
+        """
+        if task != "REMOVE_BG":
+            results = []
+            for image_bytes in images_bytes:
+                try:
+                    results.append(self.process_image(image_bytes, task=task, instruction=instruction, params=params, output=output))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        log.debug("Processing batch of %d images", len(images_bytes))
+        params = self._matting_params(params)
+        output = output_options(output)
+        results = [None] * len(images_bytes)
+        pending = []
+        for i, image_bytes in enumerate(images_bytes):
+            with stage("hash"):
+                content_key = self.cache.content_hash(image_bytes)
+            output_key = self.cache.key("output", content_key, self._decode_dim(task, params), task, instruction, params, output)
+            cached = self.cache.get(output_key)
+            if cached is not None:
+                results[i] = cached
+                continue
+            try:
+                pending.append((i, self.decode_image(image_bytes, self._decode_dim(task, params)), content_key, output_key))
+            except Exception as e:
+                results[i] = e
+
+        # Only images whose coarse mask is not cached go through the network
+        model_name = MODEL_TIERS[params["quality"]]
+        masks = {i: self.cache.get(self.cache.key("mask", ck, model_name)) for i, _, ck, _ in pending}
+        to_infer = [item for item in pending if masks[item[0]] is None]
+        step = max(1, max_batch)
+        for start in range(0, len(to_infer), step):
+            chunk = to_infer[start:start + step]
+            try:
+                chunk_masks = self.coarse_masks(
+                    [self._downscale(img[:, :, :3], self.work_dim) for _, img, _, _ in chunk], model_name
+                )
+            except Exception as e:
+                for i, _, _, _ in chunk:
+                    results[i] = e
+                continue
+            for (i, _, content_key, _), mask in zip(chunk, chunk_masks):
+                self.cache.put(self.cache.key("mask", content_key, model_name), mask)
+                masks[i] = mask
+
+        for i, img, content_key, output_key in pending:
+            if results[i] is not None:
+                continue
+            try:
+                result_img = self._run_task(img, task, instruction, params, content_key, coarse_alpha=masks[i])
+                results[i] = self._encode_result(result_img, output)
+                self.cache.put(output_key, results[i])
+            except Exception as e:
+                results[i] = e
+        return results
+
+    def coarse_masks(self, images_bgr, model_name=None):
+        """
+        Run the segmentation network on several BGR images with one session.run.
+        Mirrors rembg's preprocessing (RGB, /max, per-model mean/std and input size,
+        e.g. DIS: mean 0.5, std 1.0, 1024x1024) and postprocessing (per-image
+        min-max, resize back), returning uint8 masks.
+        """
+        with stage("inference"):
+            session = self._get_session(model_name)
+            spec = model_spec(model_name or self.model_name)
+            model_input = session.get_inputs()[0]
+            size = (spec["size"], spec["size"])
+            mean = np.float32(spec["mean"])
+            std = np.float32(spec["std"])
+
+            batch = np.empty((len(images_bgr), 3, size[1], size[0]), dtype=np.float32)
+            for n, img in enumerate(images_bgr):
+                rgb = cv2.cvtColor(cv2.resize(img, size, interpolation=cv2.INTER_LINEAR), cv2.COLOR_BGR2RGB)
+                rgb = rgb.astype(np.float32) / max(float(rgb.max()), 1e-6)
+                batch[n] = ((rgb - mean) / std).transpose(2, 0, 1)
+
+            # Some exports pin the batch dimension to 1; fall back to one run per image.
+            if model_input.shape[0] == 1:
+                preds = np.concatenate([session.run(None, {model_input.name: batch[n:n + 1]})[0] for n in range(len(batch))])
             else:
-                print(f"[Engine] Unknown instruction: {instruction}")
-            
-        print("[Engine] No matching task, returning original")
-        return self._encode_result(img)
+                preds = session.run(None, {model_input.name: batch})[0]
+
+            masks = []
+            for img, pred in zip(images_bgr, preds[:, 0, :, :]):
+                mi, ma = float(pred.min()), float(pred.max())
+                pred = (pred - mi) / max(ma - mi, 1e-6)
+                mask = (pred * 255).astype(np.uint8)
+                masks.append(cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_LINEAR))
+        return masks
+
+    def guided_matting_pipeline(self, img_bgr, coarse_alpha=None, params=None, content_key=None):
+        return self._encode_result(self.matting_array(img_bgr, coarse_alpha, params, content_key))
+
+    def matting_array(self, img_bgr, coarse_alpha=None, params=None, content_key=None):
+        """Catalog shot: the matted product laid out on the white 2048 canvas."""
+        src_bgr, final_alpha = self.alpha_matte(img_bgr, coarse_alpha, params, content_key)
+
+        # Merge
+        with stage("composite"):
+            return self.layout_array(self._cutout(src_bgr, final_alpha))
+
+    @staticmethod
+    def _cutout(src_bgr, alpha):
+        """BGRA of the alpha's bounding box only: the layout crops to it anyway."""
+        x, y, w, h = cv2.boundingRect(alpha)
+        if w == 0:
+            x, y, w, h = 0, 0, alpha.shape[1], alpha.shape[0]
+        return cv2.merge([*cv2.split(src_bgr[y:y + h, x:x + w]), alpha[y:y + h, x:x + w]])
 
-    def guided_matting_pipeline(self, img_bgr):
+    def alpha_matte(self, img_bgr, coarse_alpha=None, params=None, content_key=None):
         """
         V3: Coarse-to-Fine Matting Pipeline
-        1. Coarse Mask (Encoder): u2net/isnet via rembg.
+        1. Coarse Mask (Encoder): isnet session via coarse_masks (or precomputed by process_many).
         2. Trimap Generation: Erode (FG) vs Dilate (BG) -> Unknown Region.
         3. Guided Filter: Refine alpha in the Unknown Region.
+        Steps 1-2 run at the working size; with full_resolution the image is larger and
+        step 3 refines the edge band against its original pixels.
+        With a content_key, the coarse mask and the refined alpha are cached separately,
+        so changing a refinement parameter does not re-run the network.
+        Returns (src_bgr, final_alpha).
         """
+        params = self._matting_params(params)
         
         # Prepare input for rembg
         # If input has alpha, drop it for the detection phase
@@ -70,22 +486,40 @@ class BatchBGEngine:
         else:
             src_bgr = img_bgr
 
-        # 1. Coarse Mask (Inference)
-        # Reverting CLAHE as it confused the model on shiny surfaces (black metal became white).
-        success, encoded_src = cv2.imencode('.png', src_bgr)
-        input_bytes = encoded_src.tobytes()
-        
-        # Run standard rembg
-        output_bytes = remove(input_bytes, session=self._get_session())
-        
-        nparr = np.frombuffer(output_bytes, np.uint8)
-        rembg_output = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-        
-        if rembg_output is None or rembg_output.shape[2] < 4:
-            print("[Engine] Warning: rembg failed to produce alpha")
-            coarse_alpha = 255 * np.ones(src_bgr.shape[:2], dtype=np.uint8)
-        else:
-            coarse_alpha = rembg_output[:, :, 3]
+        model_name = MODEL_TIERS[params["quality"]]
+        # The same content may be matted at working size (/images) or full resolution
+        alpha_key = self.cache.key("alpha", content_key, src_bgr.shape[:2], model_name, params) if content_key else None
+        final_alpha = self.cache.get(alpha_key) if alpha_key else None
+        if final_alpha is None:
+            mask_key = self.cache.key("mask", content_key, model_name) if content_key else None
+            if coarse_alpha is None and mask_key:
+                coarse_alpha = self.cache.get(mask_key)
+
+            # 1. Coarse Mask (Inference)
+            # Reverting CLAHE as it confused the model on shiny surfaces (black metal became white).
+            # The array goes straight to the ONNX session: no PNG encode/decode round-trip
+            # through rembg.remove just to read back the alpha channel.
+            if coarse_alpha is None:
+                coarse_alpha = self.coarse_masks([self._downscale(src_bgr, self.work_dim)], model_name)[0]
+                if mask_key:
+                    self.cache.put(mask_key, coarse_alpha)
+
+            final_alpha = self.refine_alpha(src_bgr, coarse_alpha, params)
+            if alpha_key:
+                self.cache.put(alpha_key, final_alpha)
+
+        return src_bgr, final_alpha
+
+    def refine_alpha(self, src_bgr, coarse_alpha, params):
+        """
+        Coarse mask -> threshold, hole filling, overshoot, trimap and guided filter -> final alpha.
+        Morphology runs at the coarse mask's resolution; the final alpha is at src_bgr's,
+        which may be larger (multi-resolution mode).
+        Everything after the threshold runs on the subject's bounding box plus a margin
+        wider than the morphology can grow the mask, so the result matches a full-frame
+        run (up to ±1 interpolation rounding when the mask is upsampled) while small
+        products on large backgrounds skip the empty pixels.
+        """
 
         # REFINED STRATEGY 6: "Overshoot & Refine"
         # Problem: The black product is getting eaten (mask is too small).
@@ -94,296 +528,437 @@ class BatchBGEngine:
         # 2. DILATE (Grow) the mask to cover the missing edges.
         # 3. Use Guided Filter to cut back the excess based on color difference.
         
-        # A. Extremely Low Threshold
-        # Keep everything. Even faint shadows? Yes, Matting will fix shadows later.
-        _, solid_mask = cv2.threshold(coarse_alpha, 1, 255, cv2.THRESH_BINARY)
-        
-        # B. Aggressive Hole Filling
-        # Kernel 5x5 (Reduced from 21x21).
-        # We want to fill "noise" holes, but NOT structural holes like the grille vents.
-        close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        solid_mask = cv2.morphologyEx(solid_mask, cv2.MORPH_CLOSE, close_kernel)
-        
-        # C. OVERSHOOT (Dilate)
-        # Grow the object to recover the "bitten" black edges.
-        dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-        solid_mask = cv2.dilate(solid_mask, dilate_kernel, iterations=2)
-        
-        # Update coarse_alpha
-        coarse_alpha = solid_mask
-
-        # 2. Trimap Generation
-        # Now we have an OVERSIZED solid block.
-        # We need the Trimap to cover the transition from Object -> Background.
-        k_size = 10
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k_size, k_size))
-        
-        # Dilate -> Definite BG boundary (Outer limit)
-        dilated = cv2.dilate(coarse_alpha, kernel, iterations=1)
-        
-        # Erode -> Definite FG boundary (Inner core)
-        eroded = cv2.erode(coarse_alpha, kernel, iterations=2)
-        
-        # Trimap: Unknown region
-        unknown_mask = cv2.bitwise_xor(dilated, eroded)
+        h, w = src_bgr.shape[:2]
+        with stage("morphology"):
+            # A. Extremely Low Threshold
+            # Keep everything. Even faint shadows? Yes, Matting will fix shadows later.
+            _, solid_mask = cv2.threshold(coarse_alpha, params["threshold"], 255, cv2.THRESH_BINARY)
+
+            # Subject ROI: closing, overshoot and the trimap dilation grow the mask by at
+            # most this much; one more pixel keeps the ROI border at zero
+            bx, by, bw, bh = cv2.boundingRect(solid_mask)
+            if bw == 0:
+                log.debug("No foreground detected")
+                return np.zeros((h, w), dtype=np.uint8)
+            margin = params["close_kernel"] // 2 + params["dilate_iterations"] + params["trimap_kernel"] // 2 + 2
+            mh, mw = solid_mask.shape
+            ox, oy = max(0, bx - margin), max(0, by - margin)
+            solid_mask = solid_mask[oy:min(mh, by + bh + margin), ox:min(mw, bx + bw + margin)]
+
+            # B. Aggressive Hole Filling
+            # Kernel 5x5 (Reduced from 21x21).
+            # We want to fill "noise" holes, but NOT structural holes like the grille vents.
+            close_size = params["close_kernel"]
+            close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (close_size, close_size))
+            solid_mask = cv2.morphologyEx(solid_mask, cv2.MORPH_CLOSE, close_kernel)
+
+            # C. OVERSHOOT (Dilate)
+            # Grow the object to recover the "bitten" black edges.
+            dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+            solid_mask = cv2.dilate(solid_mask, dilate_kernel, iterations=params["dilate_iterations"])
+
+            # Update coarse_alpha
+            coarse_alpha = solid_mask
+
+            # 2. Trimap Generation
+            # Now we have an OVERSIZED solid block.
+            # We need the Trimap to cover the transition from Object -> Background.
+            k_size = params["trimap_kernel"]
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k_size, k_size))
+
+            # Dilate -> Definite BG boundary (Outer limit)
+            dilated = cv2.dilate(coarse_alpha, kernel, iterations=1)
+
+            # Erode -> Definite FG boundary (Inner core)
+            eroded = cv2.erode(coarse_alpha, kernel, iterations=2)
+
+            # Trimap: Unknown region
+            unknown_mask = cv2.bitwise_xor(dilated, eroded)
         
         # If the unknown area is too small, just return coarse alpha (optimization)
         if cv2.countNonZero(unknown_mask) < 100:
-             print("[Engine] Edge clean enough, skipping Guided Filter.")
-             final_alpha = coarse_alpha
+             log.debug("Edge clean enough, skipping Guided Filter")
+             final_alpha = np.zeros((mh, mw), dtype=np.uint8)
+             final_alpha[oy:oy + coarse_alpha.shape[0], ox:ox + coarse_alpha.shape[1]] = coarse_alpha
+             if final_alpha.shape != (h, w):
+                 final_alpha = cv2.resize(final_alpha, (w, h), interpolation=cv2.INTER_LINEAR)
         else:
-            # 3. Guided Filter Refinement
-            # Normalize to 0-1 float
-            guide = src_bgr.astype(np.float32) / 255.0
-            src_alpha_f = coarse_alpha.astype(np.float32) / 255.0
-            
-            # Parameters for Guided Filter
-            radius = 20
-            eps = 1e-6
-            
-            refined_alpha = self.fast_guided_filter(guide, src_alpha_f, radius, eps)
-            refined_alpha = np.clip(refined_alpha * 255, 0, 255).astype(np.uint8)
-            
+            # 3. Guided Filter Refinement, only where it is used: the unknown band
             # 4. Composite: Keep Definite FG/BG, replace only Unknown
-            # Start with refined
-            final_alpha = refined_alpha
-            
-            # Force Definite FG (restore solidity)
-            # Use the eroded (Solid Core) to overwrite the center
-            np.putmask(final_alpha, eroded > 0, 255)
-            
-            # Force Definite BG
-            np.putmask(final_alpha, dilated == 0, 0)
+            # Definite BG (outside dilated) stays 0, Definite FG (eroded core) is 255.
+            final_alpha = np.zeros((h, w), dtype=np.uint8)
+            with stage("guided_filter"):
+                self.refine_unknown_band(
+                    src_bgr, coarse_alpha, unknown_mask, eroded, final_alpha,
+                    radius=params["gf_radius"], eps=params["gf_eps"],
+                    subsample=params["gf_subsample"], tile=params["gf_tile"],
+                    origin=(ox, oy), mask_size=(mw, mh),
+                )
 
-        # Merge
-        b, g, r = cv2.split(src_bgr)
-        rgba_final = cv2.merge([b, g, r, final_alpha])
-        
-        return self.layout_on_white(rgba_final)
+        return final_alpha
+
+    def refine_unknown_band(self, src_bgr, coarse_alpha, unknown_mask, core_mask, out, radius, eps, subsample=2, tile=256,
+                            origin=(0, 0), mask_size=None):
+        """
+        Build the final alpha into `out` tile by tile: definite foreground from `core_mask`,
+        and the colour guided filter on the tiles that contain unknown pixels. Each filtered
+        tile gets a halo covering the two cascaded box windows (radius/2 each side, each)
+        plus the subsampling footprint, so seams don't show.
+        The masks may be smaller than src_bgr: each tile then samples them at full
+        resolution, and radius, subsampling and tile size grow by the same factor, so the
+        coefficients are still computed on a mask-sized grid while the output follows
+        the original pixels. Memory stays bounded by the tile size either way.
+        The masks may also be an ROI of a (mask_size) frame starting at `origin`: only
+        tiles over the ROI are visited, the rest of `out` is left as is (zeros).
+        """
+        h, w = src_bgr.shape[:2]
+        mw, mh = mask_size or (unknown_mask.shape[1], unknown_mask.shape[0])
+        sx, sy = w / mw, h / mh
+        ox, oy = origin
+        scale = max(sx, sy)
+        radius, subsample, tile = int(round(radius * scale)), subsample * scale, int(round(tile * scale))
+        halo = int(math.ceil(radius + 2 * subsample))
+        # Tiles stay on the full-frame grid, so results match a full-frame run
+        roi_x0, roi_y0 = int(ox * sx) // tile * tile, int(oy * sy) // tile * tile
+        roi_x1 = min(w, int(math.ceil((ox + unknown_mask.shape[1]) * sx)))
+        roi_y1 = min(h, int(math.ceil((oy + unknown_mask.shape[0]) * sy)))
+        window = lambda mask, x, y, ww, wh, interp: self._mask_window(mask, x, y, ww, wh, sx, sy, interp, origin)
+        for ty in range(roi_y0, roi_y1, tile):
+            for tx in range(roi_x0, roi_x1, tile):
+                th, tw = min(tile, h - ty), min(tile, w - tx)
+                out_tile = out[ty:ty + th, tx:tx + tw]
+                out_tile[:] = window(core_mask, tx, ty, tw, th, cv2.INTER_NEAREST)
+                tile_unknown = window(unknown_mask, tx, ty, tw, th, cv2.INTER_NEAREST)
+                if not cv2.countNonZero(tile_unknown):
+                    continue
+
+                y0, y1 = max(0, ty - halo), min(h, ty + th + halo)
+                x0, x1 = max(0, tx - halo), min(w, tx + tw + halo)
+                guide = src_bgr[y0:y1, x0:x1].astype(np.float32) * (1 / 255.0)
+                p = window(coarse_alpha, x0, y0, x1 - x0, y1 - y0, cv2.INTER_LINEAR)
+                p = p.astype(np.float32) * (1 / 255.0)
+
+                q = self.fast_guided_filter(guide, p, radius, eps, subsample)
+
+                # Back to the tile's own (halo-free) window
+                iy, ix = ty - y0, tx - x0
+                refined = np.clip(q[iy:iy + th, ix:ix + tw] * 255, 0, 255).astype(np.uint8)
+                np.copyto(out_tile, refined, where=tile_unknown > 0)
+        return out
+
+    @staticmethod
+    def _mask_window(mask, x, y, w, h, sx, sy, interpolation, origin=(0, 0)):
+        """
+        Window (x, y, w, h) of `mask` upsampled by (sx, sy), sampled on the same grid as cv2.resize.
+        `mask` may be an ROI starting at `origin` of the full mask; outside it the
+        border is replicated (the ROI border is zero, or the frame edge).
+        """
+        ox, oy = origin
+        if sx == 1 and sy == 1:
+            x, y = x - ox, y - oy
+            mh, mw = mask.shape[:2]
+            if x >= 0 and y >= 0 and x + w <= mw and y + h <= mh:
+                return mask[y:y + h, x:x + w]
+            cx0, cy0 = min(max(x, 0), mw - 1), min(max(y, 0), mh - 1)
+            cx1, cy1 = max(min(x + w, mw), cx0 + 1), max(min(y + h, mh), cy0 + 1)
+            return cv2.copyMakeBorder(
+                mask[cy0:cy1, cx0:cx1], cy0 - y, y + h - cy1, cx0 - x, x + w - cx1, cv2.BORDER_REPLICATE
+            )[:h, :w]
+        # dst(u, v) = mask((x + u + 0.5) / sx - 0.5 - ox, (y + v + 0.5) / sy - 0.5 - oy)
+        m = np.float32([[1 / sx, 0, (x + 0.5) / sx - 0.5 - ox], [0, 1 / sy, (y + 0.5) / sy - 0.5 - oy]])
+        return cv2.warpAffine(
+            mask, m, (w, h), flags=interpolation | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE
+        )
 
-    def fast_guided_filter(self, I, p, r, eps):
+    def fast_guided_filter(self, I, p, r, eps, s=2):
         """
-        O(N) Fast Guided Filter implementation using OpenCV boxFilter.
-        I: Guide image (normalized float)
-        p: Input image (mask) (normalized float)
-        r: Radius
+        O(N) Fast Colour Guided Filter (He et al.), box filters via OpenCV.
+        I: Guide image, BGR float32 in [0, 1]
+        p: Input image (mask), float32 in [0, 1]
+        r: Box window size at full resolution (r / s after subsampling)
         eps: Epsilon regularization
+        s: Subsampling factor for the coefficient computation
         """
-        # Resize for speed (Fast Guided Filter)
-        # s = 0.5 (subsampling)
         h, w = p.shape[:2]
-        h_s, w_s = int(h/2), int(w/2)
-        I_sub = cv2.resize(I, (w_s, h_s), interpolation=cv2.INTER_NEAREST)
-        p_sub = cv2.resize(p, (w_s, h_s), interpolation=cv2.INTER_NEAREST)
-        r_sub = int(r / 2)
-
-        mean_I = cv2.boxFilter(I_sub, cv2.CV_32F, (r_sub, r_sub))
-        mean_p = cv2.boxFilter(p_sub, cv2.CV_32F, (r_sub, r_sub))
-        mean_Ip = cv2.boxFilter(I_sub * p_sub[:,:,None], cv2.CV_32F, (r_sub, r_sub)) # I is color, p is single
-        # Fix dimensions: p is (H,W), I is (H,W,3). 
-        # Actually standard GF assumes Is is grayscale or handles multi-channel guide separately.
-        # For simplicity and color-edge awareness, let's use Grayscale Guide or average covariance.
-        
-        # Color Guided Filter is complex to write from scratch in 10 lines.
-        # Let's use Grayscale Guide for stability and speed.
-        I_gray_sub = cv2.cvtColor(I_sub, cv2.COLOR_BGR2GRAY)
-        
-        mean_I = cv2.boxFilter(I_gray_sub, cv2.CV_32F, (r_sub, r_sub))
-        mean_p = cv2.boxFilter(p_sub, cv2.CV_32F, (r_sub, r_sub))
-        mean_Ip = cv2.boxFilter(I_gray_sub * p_sub, cv2.CV_32F, (r_sub, r_sub))
-        mean_II = cv2.boxFilter(I_gray_sub * I_gray_sub, cv2.CV_32F, (r_sub, r_sub))
+        h_s, w_s = max(1, int(h / s)), max(1, int(w / s))
+        I_sub = cv2.resize(I, (w_s, h_s), interpolation=cv2.INTER_AREA)
+        p_sub = cv2.resize(p, (w_s, h_s), interpolation=cv2.INTER_AREA)
+        win = (max(1, int(r / s)),) * 2
+
+        def box(x):
+            return cv2.boxFilter(x, cv2.CV_32F, win)
+
+        Ib, Ig, Ir = cv2.split(I_sub)
+        mean_b, mean_g, mean_r = cv2.split(box(I_sub))
+        mean_p = box(p_sub)
+
+        cov_b = box(Ib * p_sub) - mean_b * mean_p
+        cov_g = box(Ig * p_sub) - mean_g * mean_p
+        cov_r = box(Ir * p_sub) - mean_r * mean_p
 
-        cov_Ip = mean_Ip - mean_I * mean_p
-        var_I = mean_II - mean_I * mean_I
+        # Covariance of the guide (symmetric 3x3 per pixel), regularized
+        var_bb = box(Ib * Ib) - mean_b * mean_b + eps
+        var_bg = box(Ib * Ig) - mean_b * mean_g
+        var_br = box(Ib * Ir) - mean_b * mean_r
+        var_gg = box(Ig * Ig) - mean_g * mean_g + eps
+        var_gr = box(Ig * Ir) - mean_g * mean_r
+        var_rr = box(Ir * Ir) - mean_r * mean_r + eps
 
-        a = cov_Ip / (var_I + eps)
-        b = mean_p - a * mean_I
+        # a = Sigma^-1 cov_Ip, inverse via cofactors
+        inv_bb = var_gg * var_rr - var_gr * var_gr
+        inv_bg = var_gr * var_br - var_bg * var_rr
+        inv_br = var_bg * var_gr - var_gg * var_br
+        inv_gg = var_bb * var_rr - var_br * var_br
+        inv_gr = var_br * var_bg - var_bb * var_gr
+        inv_rr = var_bb * var_gg - var_bg * var_bg
+        # det(Sigma + eps*I) >= eps^3; float32 cancellation on flat guides can reach 0
+        det = np.maximum(var_bb * inv_bb + var_bg * inv_bg + var_br * inv_br, np.float32(eps) ** 3)
 
-        mean_a = cv2.boxFilter(a, cv2.CV_32F, (r_sub, r_sub))
-        mean_b = cv2.boxFilter(b, cv2.CV_32F, (r_sub, r_sub))
+        a_b = (inv_bb * cov_b + inv_bg * cov_g + inv_br * cov_r) / det
+        a_g = (inv_bg * cov_b + inv_gg * cov_g + inv_gr * cov_r) / det
+        a_r = (inv_br * cov_b + inv_gr * cov_g + inv_rr * cov_r) / det
+        b = mean_p - a_b * mean_b - a_g * mean_g - a_r * mean_r
 
-        # Upsample
+        mean_a = box(cv2.merge([a_b, a_g, a_r]))
+        mean_b_coef = box(b)
+
+        # Upsample the coefficients and apply them to the full-resolution guide
         mean_a = cv2.resize(mean_a, (w, h), interpolation=cv2.INTER_LINEAR)
-        mean_b = cv2.resize(mean_b, (w, h), interpolation=cv2.INTER_LINEAR)
-        
-        # Guide needs to be gray here too for the linear apply
-        I_gray = cv2.cvtColor(I, cv2.COLOR_BGR2GRAY)
-        q = mean_a * I_gray + mean_b
-        return q
+        mean_b_coef = cv2.resize(mean_b_coef, (w, h), interpolation=cv2.INTER_LINEAR)
+        # q = a . I + b; cv2.transform sums the three channel products in one pass
+        q = cv2.transform(cv2.multiply(mean_a, I), np.ones((1, 3), dtype=np.float32))
+        return cv2.add(q, mean_b_coef)
 
     def layout_on_white(self, cropped_rgba):
+        return self._encode_result(self.layout_array(cropped_rgba))
+
+    def layout_array(self, cropped_rgba, canvas=(2048, 2048), padding_ratio=0.8, background=(255, 255, 255)):
+        """
+        Crop to the product, scale its long side to `padding_ratio` of the canvas and
+        centre it. background=None gives a transparent BGRA canvas instead.
+        """
+        target_w, target_h = canvas
+
+        def empty_canvas():
+            if background is None:
+                return np.zeros((target_h, target_w, 4), dtype=np.uint8)
+            return solid_canvas(target_h, target_w, background)
+
         # Find Bounding Box
         alpha = cropped_rgba[:, :, 3]
         coords = cv2.findNonZero(alpha)
         if coords is None:
-             print("[Engine] No foreground detected, returning white canvas.")
-             final_canvas = np.full((2048, 2048, 3), 255, dtype=np.uint8)
-             return self._encode_result(final_canvas)
+             log.debug("No foreground detected, returning an empty canvas")
+             return empty_canvas()
 
         x, y, w, h = cv2.boundingRect(coords)
         cropped = cropped_rgba[y:y+h, x:x+w]
         
-        # Scale to 80% of 2048
-        target_size = 2048
-        padding_ratio = 0.8
-        max_dim = int(target_size * padding_ratio)
-        
+        # Scale to 80% of 2048 by default
         h_c, w_c = cropped.shape[:2]
         if h_c == 0 or w_c == 0:
-             final_canvas = np.full((2048, 2048, 3), 255, dtype=np.uint8)
-             return self._encode_result(final_canvas)
+             return empty_canvas()
 
-        scale = max_dim / max(h_c, w_c)
-        new_w, new_h = int(w_c * scale), int(h_c * scale)
+        scale = min(int(target_w * padding_ratio) / w_c, int(target_h * padding_ratio) / h_c)
+        new_w, new_h = max(1, int(w_c * scale)), max(1, int(h_c * scale))
         
         resized = cv2.resize(cropped, (new_w, new_h), interpolation=cv2.INTER_AREA)
         
         # Create Canvas (White)
-        canvas = np.full((target_size, target_size, 3), 255, dtype=np.uint8)
+        canvas = empty_canvas()
         
         # Centering
-        start_x = (target_size - new_w) // 2
-        start_y = (target_size - new_h) // 2
-        
-        # Alpha Compositing
-        fg_alpha = resized[:, :, 3] / 255.0
-        fg_color = resized[:, :, 0:3]
-        
-        end_y = min(start_y + new_h, target_size)
-        end_x = min(start_x + new_w, target_size)
-        
-        bg_slice = canvas[start_y:end_y, start_x:end_x]
-        
-        fg_h, fg_w = bg_slice.shape[:2]
-        if fg_h != new_h or fg_w != new_w:
-            fg_alpha = fg_alpha[:fg_h, :fg_w]
-            fg_color = fg_color[:fg_h, :fg_w]
-            
-        for c in range(3):
-            bg_slice[:, :, c] = (fg_color[:, :, c] * fg_alpha + bg_slice[:, :, c] * (1 - fg_alpha))
-            
-        canvas[start_y:end_y, start_x:end_x] = bg_slice
+        start_x = (target_w - new_w) // 2
+        start_y = (target_h - new_h) // 2
         
-        return self._encode_result(canvas)
+        end_y = min(start_y + new_h, target_h)
+        end_x = min(start_x + new_w, target_w)
+        fg_h, fg_w = end_y - start_y, end_x - start_x
 
-    def adjust_brightness(self, img, instruction_val=None):
-        print(f"[Engine] Adjusting Brightness... Validation: {instruction_val}")
+        if background is None:
+            canvas[start_y:end_y, start_x:end_x] = resized[:fg_h, :fg_w]
+            return canvas
+
+        # Alpha Compositing, in place on the canvas region
+        blend_over(
+            canvas[start_y:end_y, start_x:end_x],
+            resized[:fg_h, :fg_w, :3],
+            np.ascontiguousarray(resized[:fg_h, :fg_w, 3]),
+        )
         
-        # Parse factor from instruction string "brightness:1.5" or just "brightness"
-        factor = 1.2 # Default boost
-        if instruction_val and ":" in instruction_val:
-            try:
-                val_str = instruction_val.split(":")[1]
-                factor = float(val_str)
-            except ValueError:
-                print(f"[Engine] Invalid brightness value: {instruction_val}")
+        return canvas
 
-        print(f"[Engine] Applying brightness factor: {factor}")
+    # --- Variants ----------------------------------------------------------
+    # Several deliverables (catalog square, thumbnail, cutout, shadowed shot...)
+    # rendered from one decode and one matte.
 
-        # Handle Alpha
-        has_alpha = False
-        alpha = None
-        if img.shape[2] == 4:
-            has_alpha = True
-            b, g, r, alpha = cv2.split(img)
-            img_bgr = cv2.merge([b, g, r])
-        else:
-            img_bgr = img
+    def process_variants(self, image_bytes, variants, params=None):
+        """Returns [(name, media_type, encoded_bytes)] in the order of `variants`."""
+        params = self._matting_params(params)
+        variants = [variant_options(v, i) for i, v in enumerate(variants)]
+        if not variants:
+            raise ValueError("No variants requested")
 
-        hsv = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2HSV)
-        h, s, v = cv2.split(hsv)
-        
-        # Multiply V by factor
-        # v is uint8 (0-255). We need to convert to float to prevent overflow then clip.
-        v_float = v.astype(np.float32)
-        v_float = v_float * factor
-        v_float = np.clip(v_float, 0, 255)
-        v = v_float.astype(np.uint8)
-        
-        final_hsv = cv2.merge((h, s, v))
-        final_bgr = cv2.cvtColor(final_hsv, cv2.COLOR_HSV2BGR)
-        
-        if has_alpha:
-            b, g, r = cv2.split(final_bgr)
-            final_img = cv2.merge([b, g, r, alpha])
-        else:
-            final_img = final_bgr
-            
-        return self._encode_result(final_img)
+        with stage("hash"):
+            content_key = self.cache.content_hash(image_bytes)
+        model_name = MODEL_TIERS[params["quality"]]
+        decode_dim = self._decode_dim("REMOVE_BG", params)
+        results, img, matte = [], None, None
+        for variant in variants:
+            output = variant["output"]
+            key = self.cache.key(
+                "variant", content_key, decode_dim, model_name, params, {k: v for k, v in variant.items() if k != "name"}
+            )
+            encoded = self.cache.get(key)
+            if encoded is None:
+                if matte is None:
+                    img = self.decode_image(image_bytes, decode_dim)
+                    matte = self.alpha_matte(img, params=params, content_key=content_key)
+                encoded = self._encode_result(self.render_variant(*matte, variant), output)
+                self.cache.put(key, encoded)
+            results.append((variant["name"], OUTPUT_FORMATS[output["format"]][1], encoded))
+        return results
 
-    def adjust_saturation(self, img, instruction_val=None):
-        print(f"[Engine] Adjusting Saturation... {instruction_val}")
-        factor = 1.2
-        if instruction_val and ":" in instruction_val:
-            try:
-                factor = float(instruction_val.split(":")[1])
-            except:
-                pass
+    def render_variant(self, src_bgr, alpha, variant):
+        with stage("composite"):
+            background = variant["background"]
+            if variant["canvas"] is None:
+                laid_out = cv2.merge([*cv2.split(src_bgr), alpha])
+            else:
+                # Shadows are cast on the transparent layout, then flattened
+                laid_out = self.layout_array(
+                    self._cutout(src_bgr, alpha), variant["canvas"], variant["padding_ratio"],
+                    None if variant["shadow"] else background,
+                )
+            if laid_out.shape[2] == 3:
+                return laid_out
 
-        # Handle Alpha
-        has_alpha = False
-        alpha = None
-        if img.shape[2] == 4:
-            has_alpha = True
-            b, g, r, alpha = cv2.split(img)
-            img_bgr = cv2.merge([b, g, r])
-        else:
-            img_bgr = img
+            shadow = self.shadow_alpha(laid_out[:, :, 3], variant["shadow"]) if variant["shadow"] else None
+            if background is None:
+                return laid_out if shadow is None else shadow_under(laid_out, shadow)
+            h, w = laid_out.shape[:2]
+            canvas = solid_canvas(h, w, background)
+            if shadow is not None:
+                blend_color(canvas, (0, 0, 0), shadow)
+            return blend_over(canvas, laid_out[:, :, :3], np.ascontiguousarray(laid_out[:, :, 3]))
 
-        hsv = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2HSV)
-        h, s, v = cv2.split(hsv)
-        
-        # Multiply S by factor
-        s_float = s.astype(np.float32)
-        s_float = s_float * factor
-        s_float = np.clip(s_float, 0, 255)
-        s = s_float.astype(np.uint8)
-        
-        final_hsv = cv2.merge((h, s, v))
-        final_bgr = cv2.cvtColor(final_hsv, cv2.COLOR_HSV2BGR)
-        
-        if has_alpha:
-            b, g, r = cv2.split(final_bgr)
-            final_img = cv2.merge([b, g, r, alpha])
-        else:
-            final_img = final_bgr
-            
-        return self._encode_result(final_img)
+    # --- Edits -------------------------------------------------------------
+    # An EDIT instruction is an ordered list of operations separated by ';',
+    # e.g. "brightness:1.2;contrast:1.1;saturation:0.9;shadow". Consecutive ops of
+    # the same kind are composed into one lookup-table stage (compile_edit_ops):
+    # each stage is one pass over the pixels, and each HSV stage its own HSV
+    # round-trip. Contrast works on BGR and doesn't commute with the HSV ops, so
+    # "brightness;contrast;saturation" stays three stages. One encode at the end.
 
-    def adjust_contrast(self, img, instruction_val=None):
-        print(f"[Engine] Adjusting Contrast... {instruction_val}")
-        factor = 1.2
-        if instruction_val and ":" in instruction_val:
-            try:
-                factor = float(instruction_val.split(":")[1])
-            except:
-                pass
-                
-        # Handle Alpha
-        has_alpha = False
-        alpha = None
-        if img.shape[2] == 4:
-            has_alpha = True
-            b, g, r, alpha = cv2.split(img)
-            img_bgr = cv2.merge([b, g, r])
-        else:
-            img_bgr = img
+    EDIT_DEFAULT_FACTOR = 1.2
 
-        # Apply contrast using convertScaleAbs
-        # new_image = alpha * old_image + beta
-        # We assume factor is alpha (contrast control). beta is brightness (0 here)
-        final_bgr = cv2.convertScaleAbs(img_bgr, alpha=factor, beta=0)
+    def parse_edit_ops(self, instruction):
+        ops = []
+        for part in (instruction or "").split(";"):
+            part = part.strip()
+            if not part:
+                continue
+            name, _, value = part.partition(":")
+            name = name.strip()
+            if name not in ("brightness", "saturation", "contrast", "shadow"):
+                log.warning("Unknown instruction: %s", part)
+                continue
+            # "shadow:0.5" sets the shadow's opacity; without a value it uses DEFAULT_SHADOW
+            factor = None if name == "shadow" else self.EDIT_DEFAULT_FACTOR
+            if value:
+                try:
+                    factor = float(value)
+                except ValueError:
+                    log.warning("Invalid %s value: %s", name, part)
+                if name == "shadow" and factor is not None and not 0 <= factor <= 1:
+                    log.warning("Shadow opacity out of [0, 1]: %s", part)
+                    factor = None
+            ops.append((name, factor))
+        return ops
 
-        if has_alpha:
-            b, g, r = cv2.split(final_bgr)
-            final_img = cv2.merge([b, g, r, alpha])
-        else:
-            final_img = final_bgr
-            
-        return self._encode_result(final_img)
+    def compile_edit_ops(self, ops):
+        """
+        Fold an op list into stages:
+        - ("bgr", lut): per-channel LUT on B, G, R (contrast)
+        - ("hsv", s_lut, v_lut): LUTs on S and V, H untouched (saturation, brightness)
+        - ("shadow", opacity): drop shadow compositing (opacity None: the default)
+        Adjacent ops of the same kind are composed into a single LUT.
+        """
+        identity = np.arange(256, dtype=np.uint8)
+        # float32 like the original per-op code paths, so single ops match them bit for bit
+        levels = np.arange(256, dtype=np.float32)
+        stages = []
+        for name, factor in ops:
+            if name == "shadow":
+                stages.append(("shadow", factor))
+                continue
+
+            if name == "contrast":
+                # Same rounding as cv2.convertScaleAbs(alpha=factor, beta=0)
+                lut = np.clip(np.rint(np.abs(levels * np.float32(factor))), 0, 255).astype(np.uint8)
+                if stages and stages[-1][0] == "bgr":
+                    stages[-1] = ("bgr", lut[stages[-1][1]])
+                else:
+                    stages.append(("bgr", lut))
+                continue
+
+            # brightness scales V, saturation scales S (truncating, as the float path did)
+            lut = np.clip(levels * np.float32(factor), 0, 255).astype(np.uint8)
+            if not stages or stages[-1][0] != "hsv":
+                stages.append(("hsv", identity, identity))
+            _, s_lut, v_lut = stages[-1]
+            if name == "brightness":
+                v_lut = lut[v_lut]
+            else:
+                s_lut = lut[s_lut]
+            stages[-1] = ("hsv", s_lut, v_lut)
+        return stages
+
+    def apply_edits(self, img, instruction):
+        """Run an EDIT instruction on a BGR/BGRA array; alpha is carried through untouched."""
+        stages = self.compile_edit_ops(self.parse_edit_ops(instruction))
+        if not stages:
+            return img
+
+        alpha = img[:, :, 3] if img.shape[2] == 4 else None
+        bgr = img[:, :, :3]
+        for op_stage in stages:
+            if op_stage[0] == "bgr":
+                bgr = cv2.LUT(np.ascontiguousarray(bgr), op_stage[1])
+            elif op_stage[0] == "hsv":
+                hsv = cv2.cvtColor(np.ascontiguousarray(bgr), cv2.COLOR_BGR2HSV)
+                # LUT the S and V planes in place on the interleaved buffer
+                hsv[:, :, 1] = op_stage[1][hsv[:, :, 1]]
+                hsv[:, :, 2] = op_stage[2][hsv[:, :, 2]]
+                bgr = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+            else:
+                shadow = None if op_stage[1] is None else {"opacity": op_stage[1]}
+                shadowed = self.shadow_array(bgr if alpha is None else np.dstack([bgr, alpha]), shadow)
+                # The shadow is composited onto white: the result is opaque
+                alpha = shadowed[:, :, 3] if shadowed.shape[2] == 4 else None
+                bgr = shadowed[:, :, :3]
+
+        if alpha is None:
+            return bgr
+        out = np.empty(bgr.shape[:2] + (4,), dtype=np.uint8)
+        out[:, :, :3] = bgr
+        out[:, :, 3] = alpha
+        return out
+
+    def adjust_brightness(self, img, instruction_val=None):
+        return self._encode_result(self.apply_edits(img, instruction_val or "brightness"))
+
+    def adjust_saturation(self, img, instruction_val=None):
+        return self._encode_result(self.apply_edits(img, instruction_val or "saturation"))
 
-    def add_shadow(self, img):
-        print("[Engine] Adding Shadow...")
+    def adjust_contrast(self, img, instruction_val=None):
+        return self._encode_result(self.apply_edits(img, instruction_val or "contrast"))
+
+    def add_shadow(self, img, shadow=None):
+        return self._encode_result(self.shadow_array(img, shadow))
+
+    def shadow_array(self, img, shadow=None):
+        log.debug("Adding shadow")
         
         # Determine Mask
         if img.shape[2] == 4:
@@ -397,56 +972,106 @@ class BatchBGEngine:
             _, mask = cv2.threshold(gray, 250, 255, cv2.THRESH_BINARY_INV)
         
         if cv2.countNonZero(mask) == 0:
-            print("[Engine] Warning: No object found for shadow")
-            return self._encode_result(img)
+            log.warning("No object found for shadow")
+            return img
 
-        # Blur the mask to create soft shadow
-        shadow_blur = cv2.GaussianBlur(mask, (31, 31), 0)
-        
         h, w = img.shape[:2]
-        shadow_layer = np.zeros((h, w, 4), dtype=np.uint8)
-        
-        # Shadow color black
-        shadow_layer[:, :, 0] = 0
-        shadow_layer[:, :, 1] = 0
-        shadow_layer[:, :, 2] = 0
-        
-        # Opacity
-        shadow_layer[:, :, 3] = (shadow_blur * 0.3).astype(np.uint8)
-        
-        # Shift
-        M = np.float32([[1, 0, 20], [0, 1, 20]]) 
-        shadow_layer = cv2.warpAffine(shadow_layer, M, (w, h))
+        shadow_alpha = self.shadow_alpha(mask, shadow)
 
         # Composite
-        # Create base canvas (White)
-        canvas = np.full((h, w, 3), 255, dtype=np.uint8)
-        
-        # Blend shadow onto canvas
-        s_alpha = shadow_layer[:, :, 3] / 255.0
-        s_color = shadow_layer[:, :, 0:3]
-        
-        for c in range(3):
-            canvas[:, :, c] = (s_color[:, :, c] * s_alpha + canvas[:, :, c] * (1 - s_alpha))
+        # Create base canvas (White) and blend the shadow onto it
+        canvas = solid_canvas(h, w)
+        blend_color(canvas, (0, 0, 0), shadow_alpha)
             
-        # Blend Object onto canvas
-        # Ensure mask is 0 or 1
-        obj_mask = (mask > 0).astype(np.uint8)
-        
-        # If input image has 4 channels, we need to extract BGR for compositing
-        if img.shape[2] == 4:
-            img_bgr = img[:, :, :3]
-        else:
-            img_bgr = img
+        # Blend Object onto canvas (hard mask: take the object's pixels where mask is set)
+        paste_where(canvas, img[:, :, :3], mask)
             
-        for c in range(3):
-            # If obj_mask is 1, take img_bgr. If 0, take canvas.
-            canvas[:, :, c] = img_bgr[:, :, c] * obj_mask + canvas[:, :, c] * (1 - obj_mask)
-            
-        return self._encode_result(canvas)
+        return canvas
+
+    def shadow_alpha(self, mask, shadow=None):
+        """Soft drop shadow cast by `mask`, as an alpha-only layer (the shadow colour is black)."""
+        shadow = shadow_options(shadow)
+        h, w = mask.shape[:2]
+        out = np.zeros((h, w), dtype=np.uint8)
+        # Blurred mask at reduced resolution (cached); only its non-zero box, plus one
+        # clear pixel for the interpolation, is faded and upsampled
+        shadow_blur, factor = self._shadow_blur(mask, shadow["blur"])
+        x, y, bw, bh = cv2.boundingRect(shadow_blur)
+        if bw == 0:
+            return out
+        x0, y0 = max(x - 1, 0), max(y - 1, 0)
+        layer = cv2.multiply(shadow_blur[y0:y + bh + 1, x0:x + bw + 1], shadow["opacity"])
+        if factor > 1:
+            layer = cv2.resize(layer, None, fx=factor, fy=factor, interpolation=cv2.INTER_LINEAR)
+
+        # Shift by pasting at the offset position, clipped to the frame
+        dx, dy = shadow["offset"]
+        px, py = x0 * factor + dx, y0 * factor + dy
+        cx0, cy0 = max(px, 0), max(py, 0)
+        cx1, cy1 = min(px + layer.shape[1], w), min(py + layer.shape[0], h)
+        if cx1 > cx0 and cy1 > cy0:
+            out[cy0:cy1, cx0:cx1] = layer[cy0 - py:cy1 - py, cx0 - px:cx1 - px]
+        return out
+
+    def _shadow_blur(self, mask, blur):
+        """
+        Gaussian blur of `mask` at 1/factor resolution (factor a power of two): a wide
+        shadow blur hides the downsampling, and the blur costs factor^2 times less.
+        Cached by the downsampled mask, so re-rendering the same shadow (another
+        opacity or offset, another variant with the same layout) skips it.
+        Returns (read-only small layer, factor).
+        """
+        h, w = mask.shape[:2]
+        sigma = 0.3 * ((blur - 1) * 0.5 - 1) + 0.8  # what GaussianBlur derives from the kernel size
+        factor = 2 ** max(0, int(math.log2(max(sigma / 2, 1))))
+        if factor > 1 and min(h, w) >= 4 * factor:
+            # Whole blocks only: the last factor-1 rows/columns at most cast no shadow
+            small = cv2.resize(
+                mask[:h // factor * factor, :w // factor * factor], (w // factor, h // factor),
+                interpolation=cv2.INTER_AREA,
+            )
+            # The area downsample and the linear upsample already add some blur
+            sigma = math.sqrt(max(sigma ** 2 - factor ** 2 / 6, 0.25)) / factor
+        else:
+            factor, small = 1, np.ascontiguousarray(mask)
+        key = self.cache.key("shadow", self.cache.content_hash(small), small.shape, blur)
+        blurred = self.cache.get(key)
+        if blurred is None:
+            blurred = cv2.GaussianBlur(small, (0, 0), sigma)
+            self.cache.put(key, blurred)
+        return blurred, factor
+
+    def _encode_result(self, img_bgr, output=None):
+        output = output_options(output)
+        with stage("encode"):
+            fmt = output["format"]
+            quality = int(output["quality"])
+            if output["preview"]:
+                img_bgr = self._downscale(img_bgr, PREVIEW_DIM)
+
+            if fmt == "png":
+                flags = [] if output["compression"] is None else [cv2.IMWRITE_PNG_COMPRESSION, int(output["compression"])]
+            elif fmt == "jpeg":
+                if img_bgr.ndim == 3 and img_bgr.shape[2] == 4:
+                    # No alpha in JPEG: flatten onto white
+                    h, w = img_bgr.shape[:2]
+                    img_bgr = blend_over(solid_canvas(h, w), img_bgr[:, :, :3], np.ascontiguousarray(img_bgr[:, :, 3]))
+                flags = [cv2.IMWRITE_JPEG_QUALITY, quality]
+            else:
+                # OpenCV switches WebP to lossless above quality 100
+                flags = [cv2.IMWRITE_WEBP_QUALITY, 101 if output["lossless"] else quality]
+
+            success, encoded_img = cv2.imencode("." + OUTPUT_FORMATS[fmt][0], img_bgr, flags)
+            if not success:
+                raise ValueError(f"Could not encode result as {fmt}")
+            return encoded_img.tobytes()
 
-    def _encode_result(self, img_bgr):
-        success, encoded_img = cv2.imencode('.png', img_bgr)
-        return encoded_img.tobytes()
 
-engine = BatchBGEngine()
+def __getattr__(name):
+    # `from engine import engine` (scripts): a shared engine built on first use,
+    # so importing this module does not create one
+    global engine
+    if name == "engine":
+        engine = BatchBGEngine()
+        return engine
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
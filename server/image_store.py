@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class ImageStore:
+    """
+    Decoded images held server-side between requests, so interactive edits don't
+    re-upload and re-decode the whole file every time.
+    Entries expire `ttl_seconds` after their last use; when the memory budget is
+    exceeded the least recently used ones are dropped first.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl_seconds=600):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # id -> (img, content_key, last_used)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_bytes=int(os.getenv("BATCHBG_IMAGE_STORE_MB", 256)) * 1024 * 1024,
+            ttl_seconds=float(os.getenv("BATCHBG_IMAGE_TTL", 600)),
+        )
+
+    def add(self, img, content_key):
+        if img.nbytes > self.max_bytes:
+            raise MemoryError("Image is larger than the image store budget")
+        image_id = uuid.uuid4().hex
+        img.flags.writeable = False
+        with self._lock:
+            self._entries[image_id] = (img, content_key, time.monotonic())
+            self._size += img.nbytes
+            self._evict()
+        return image_id
+
+    def get(self, image_id):
+        """Return (img, content_key) and refresh its TTL, or None if unknown/expired."""
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(image_id)
+            if entry is None:
+                return None
+            img, content_key, _ = entry
+            self._entries[image_id] = (img, content_key, time.monotonic())
+            self._entries.move_to_end(image_id)
+            return img, content_key
+
+    def remove(self, image_id):
+        with self._lock:
+            entry = self._entries.pop(image_id, None)
+            if entry is not None:
+                self._size -= entry[0].nbytes
+            return entry is not None
+
+    def _evict(self):
+        # Oldest first: the dict is kept in last-used order
+        now = time.monotonic()
+        while self._entries:
+            image_id, (img, _, last_used) = next(iter(self._entries.items()))
+            if self._size <= self.max_bytes and now - last_used < self.ttl_seconds:
+                break
+            del self._entries[image_id]
+            self._size -= img.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {"images": len(self._entries), "bytes": self._size}
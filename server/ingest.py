@@ -0,0 +1,237 @@
+"""
+Headless batch processing: runs the engine over a directory or glob with a
+process pool, no HTTP involved. Run from server/:
+    python ingest.py ~/fotos/lote-12 --output-dir ~/fotos/lote-12-editado --format jpeg
+    python ingest.py "catalogo/**/*.jpg" --output-dir salida --workers 8
+
+Finished items are recorded in <output-dir>/.batchbg-manifest.jsonl. Sources whose
+content hash and settings match an output still in place are skipped, so an interrupted
+run picks up where it stopped and a re-run only touches new or changed files.
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from engine import BatchBGEngine, ResultCache
+from instrumentation import configure_logging
+from options import OUTPUT_FORMATS, output_options
+
+log = logging.getLogger("batchbg.ingest")
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+MANIFEST_NAME = ".batchbg-manifest.jsonl"
+
+_engine = None
+
+
+def _init_worker(workers):
+    global _engine
+    configure_logging()
+    # ORT sizes each session's intra-op pool from the worker count (models.session_options):
+    # here that is the ingest pool, not the server's BATCHBG_WORKERS
+    os.environ["BATCHBG_WORKERS"] = str(workers)
+    # Every item is a new image: a memory cache of results would only cost RSS
+    _engine = BatchBGEngine(cache=ResultCache(max_bytes=0))
+
+
+def _process(contents, target, task, instruction, params, output):
+    # Runs in a worker process: decode, pipeline, encode, then an atomic write so a
+    # crash never leaves a truncated output behind. Returns the output's content hash.
+    result = _engine.process_image(contents, task=task, instruction=instruction, params=params, output=output)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(result)
+    os.replace(tmp, target)
+    return ResultCache.content_hash(result)
+
+
+def find_sources(pattern, recursive=False):
+    """(path, path relative to the input root) of every image under a directory or matching a glob."""
+    if os.path.isdir(pattern):
+        root = pattern
+        paths = glob.glob(os.path.join(pattern, "**" if recursive else "", "*"), recursive=recursive)
+    else:
+        paths = glob.glob(pattern, recursive=True)
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths]) if paths else ""
+    sources = [
+        p for p in paths
+        if os.path.isfile(p) and os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS
+    ]
+    # Absolute paths: the manifest must match whichever way the input was spelled
+    return [(os.path.abspath(p), os.path.relpath(os.path.abspath(p), os.path.abspath(root))) for p in sorted(sources)]
+
+
+class Manifest:
+    """Append-only record of finished items; the last line for a source wins."""
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of a run that crashed mid-write
+                        continue
+                    self.entries[entry["source"]] = entry
+        self._file = open(self.path, "a")
+
+    def lookup(self, source, settings, target):
+        """The entry for `source` if its output, made with `settings`, is still the one at `target`."""
+        entry = self.entries.get(source)
+        if entry is None or entry["settings"] != settings or entry["output"] != target:
+            return None
+        try:
+            output_mtime_ns = os.stat(target).st_mtime_ns
+        except OSError:
+            return None
+        if output_mtime_ns != entry.get("output_mtime_ns"):
+            # Rewritten since (by another input, or by hand): compare contents
+            with open(target, "rb") as f:
+                if ResultCache.content_hash(f.read()) != entry.get("output_hash"):
+                    return None
+        return entry
+
+    def add(self, entry):
+        self.entries[entry["source"]] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        # Durable before the item counts as done
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def _read_source(manifest, source, target, settings, stat, force=False):
+    """(contents, content_hash), or (None, hash) when the output is up to date.
+    Size and mtime unchanged: trust the manifest without reading the file;
+    otherwise compare content hashes."""
+    entry = None if force else manifest.lookup(source, settings, target)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return None, entry["hash"]
+    with open(source, "rb") as f:
+        contents = f.read()
+    content_hash = ResultCache.content_hash(contents)
+    if entry and entry["hash"] == content_hash:
+        # Touched but identical: record the new mtime so the next run skips the read
+        manifest.add(dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns))
+        return None, content_hash
+    return contents, content_hash
+
+
+def run(args):
+    output = output_options({"format": args.format, "quality": args.quality})
+    params = json.loads(args.params) if args.params else None
+    ext = OUTPUT_FORMATS[output["format"]][0]
+    # Outputs made with other settings are not up to date
+    settings = ResultCache.key(args.task, args.instruction, params, output)
+
+    sources = []
+    for pattern in args.inputs:
+        sources.extend(find_sources(pattern, args.recursive))
+    if not sources:
+        log.error("No images found in %s", ", ".join(args.inputs))
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(args.output_dir)
+    workers = args.workers or os.cpu_count() or 1
+    prefetch = max(1, args.prefetch) * workers
+    done = skipped = failed = 0
+    start = time.perf_counter()
+
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker, initargs=(workers,),
+    )
+    pending = {}
+    claimed = set()
+
+    def collect(block):
+        nonlocal done, failed
+        finished, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in finished:
+            entry = pending.pop(future)
+            try:
+                entry["output_hash"] = future.result()
+                entry["output_mtime_ns"] = os.stat(entry["output"]).st_mtime_ns
+            except Exception as e:
+                failed += 1
+                log.warning("%s failed: %s", entry["source"], e)
+                continue
+            manifest.add(entry)
+            done += 1
+            if done % 50 == 0:
+                log.info("%d/%d done (%.1f images/s)", done, len(sources) - skipped, done / (time.perf_counter() - start))
+
+    try:
+        for source, relative in sources:
+            target = os.path.join(args.output_dir, f"{os.path.splitext(relative)[0]}.{ext}")
+            if target in claimed:
+                # foto.jpg and foto.png in the same folder: keep the source extension
+                target = os.path.join(args.output_dir, f"{relative}.{ext}")
+            claimed.add(target)
+            try:
+                stat = os.stat(source)
+                contents, content_hash = _read_source(manifest, source, target, settings, stat, args.force)
+            except OSError as e:
+                failed += 1
+                log.warning("%s unreadable: %s", source, e)
+                continue
+            if contents is None:
+                skipped += 1
+                continue
+
+            # Keep `prefetch` items read and queued, so no worker waits on the disk
+            while len(pending) >= prefetch:
+                collect(block=True)
+            future = executor.submit(_process, contents, target, args.task, args.instruction, params, output)
+            pending[future] = {
+                "source": source, "output": target, "hash": content_hash, "settings": settings,
+                "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            }
+            collect(block=False)
+        while pending:
+            collect(block=True)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        manifest.close()
+
+    elapsed = time.perf_counter() - start
+    log.info(
+        "%d processed, %d up to date, %d failed in %.1fs (%.2f images/s)",
+        done, skipped, failed, elapsed, done / elapsed if elapsed else 0.0,
+    )
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process a directory or glob of images without the server")
+    parser.add_argument("inputs", nargs="+", help="Directory or glob (quote it), e.g. 'fotos/**/*.jpg'")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--task", default="REMOVE_BG", choices=["REMOVE_BG", "EDIT"])
+    parser.add_argument("--instruction", help="EDIT instruction, e.g. 'brightness:1.2;shadow'")
+    parser.add_argument("--params", help="JSON matting parameters (see DEFAULT_MATTING_PARAMS)")
+    parser.add_argument("--format", default="png", choices=sorted(OUTPUT_FORMATS) + ["jpg"])
+    parser.add_argument("--quality", type=int, default=90, help="JPEG/WebP quality")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per core)")
+    parser.add_argument("--prefetch", type=int, default=2, help="Images read ahead per worker")
+    parser.add_argument("--recursive", action="store_true", help="Walk subdirectories of a directory input")
+    parser.add_argument("--force", action="store_true", help="Reprocess even if the output is up to date")
+    args = parser.parse_args()
+    configure_logging()
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-stage timers. Engine code wraps each step in `with stage("decode"):`; a worker
+# job run through collect() gets back the list of (stage, seconds) it went through.
+# Outside collect() timers are no-ops, so direct engine calls (scripts, benchmarks)
+# pay nothing.
+_local = threading.local()
+
+# Stages of the jobs run on behalf of the current HTTP request (set by the middleware)
+request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+@contextmanager
+def stage(name):
+    listener = getattr(_local, "listener", None)
+    if listener is not None:
+        # May raise to abort the job at a stage boundary (cancellation)
+        listener(name)
+    stages = getattr(_local, "stages", None)
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.append((name, time.perf_counter() - start))
+
+
+def collect(fn, *args, listener=None, **kwargs):
+    """Run fn(*args, **kwargs) recording its stages. Returns (result, stages).
+    `listener(stage_name)` is called as each stage starts (job progress)."""
+    _local.stages = stages = []
+    _local.listener = listener
+    try:
+        return fn(*args, **kwargs), stages
+    finally:
+        _local.stages = None
+        _local.listener = None
+
+
+def record(stages):
+    """Attach job stages to the current request, if any."""
+    current = request_stages.get()
+    if current is not None:
+        current.extend(stages)
+
+
+def server_timing(stages):
+    """Server-Timing header value; repeated stages (e.g. a batch) are summed."""
+    totals = {}
+    for name, seconds in stages:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+def configure_logging():
+    # BATCHBG_LOG_LEVEL=DEBUG brings back the per-request messages
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(
+            level=os.getenv("BATCHBG_LOG_LEVEL", "INFO").upper(),
+            format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+        )
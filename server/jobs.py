@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+log = logging.getLogger("batchbg.jobs")
+
+# Stages a job goes through, in order, for the progress estimate
+JOB_STAGES = {
+    "REMOVE_BG": ["hash", "decode", "inference", "morphology", "guided_filter", "composite", "encode"],
+    "EDIT": ["hash", "decode", "edit", "encode"],
+}
+
+FINISHED = ("done", "failed", "cancelled")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    task TEXT NOT NULL,
+    instruction TEXT,
+    params TEXT,
+    output TEXT,
+    media_type TEXT,
+    input BLOB,
+    result BLOB,
+    error TEXT,
+    stage TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    # WAL: worker progress writes don't block the server's reads
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress:
+    """
+    Stage listener for one job (instrumentation.collect). Picklable, so it also
+    works from process-mode workers: each process opens its own connection.
+    Raises JobCancelled at the next stage boundary once the job is cancelled,
+    which frees the worker without waiting for the whole pipeline.
+    """
+
+    _connections = threading.local()
+
+    def __init__(self, path, job_id, task):
+        self.path = path
+        self.job_id = job_id
+        self.stages = JOB_STAGES.get(task, [])
+
+    def __call__(self, stage):
+        connections = self._connections.__dict__.setdefault("by_path", {})
+        conn = connections.get(self.path)
+        if conn is None:
+            conn = connections[self.path] = _connect(self.path)
+        progress = self.stages.index(stage) / len(self.stages) if stage in self.stages else None
+        with conn:
+            updated = conn.execute(
+                "UPDATE jobs SET stage = ?, progress = COALESCE(?, progress), updated = ? WHERE id = ? AND status = 'running'",
+                (stage, progress, time.time(), self.job_id),
+            ).rowcount
+        if not updated:
+            raise JobCancelled(f"Job {self.job_id} was cancelled")
+
+
+class JobQueue:
+    """
+    Persistent job backlog in SQLite: inputs, state, progress and results.
+    Jobs left running by a previous process are queued again on startup, so a
+    restart never loses work. Finished jobs are deleted `ttl_seconds` after
+    their last update. Thread-safe.
+    """
+
+    def __init__(self, path="batchbg-jobs.sqlite3", ttl_seconds=3600, max_queued=1000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+            requeued = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', stage = NULL, progress = 0 WHERE status = 'running'"
+            ).rowcount
+        if requeued:
+            log.info("Requeued %d interrupted job(s)", requeued)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv("BATCHBG_JOBS_DB", "batchbg-jobs.sqlite3"),
+            ttl_seconds=float(os.getenv("BATCHBG_JOB_TTL", 3600)),
+            max_queued=int(os.getenv("BATCHBG_JOBS_MAX_QUEUED", 1000)),
+        )
+
+    def submit(self, contents, task, instruction=None, params=None, output=None, media_type=None):
+        """Queue a job and return its id. Raises OverflowError when the backlog is full."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise OverflowError(f"Job backlog is full ({queued} queued)")
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, task, instruction, params, output, media_type, input, created, updated)"
+                " VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, task, instruction, json.dumps(params), json.dumps(output), media_type, contents, now, now),
+            )
+        return job_id
+
+    def claim(self):
+        """Mark the oldest queued job as running and return it, or None."""
+        with self._lock, self._conn:
+            self._purge()
+            row = self._conn.execute(
+                "SELECT id, task, instruction, params, output, input FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), row[0])
+            )
+        job_id, task, instruction, params, output, contents = row
+        return {
+            "id": job_id, "task": task, "instruction": instruction,
+            "params": json.loads(params), "output": json.loads(output), "contents": contents,
+        }
+
+    def finish(self, job_id, result):
+        self._set_final(job_id, "done", result=result)
+
+    def fail(self, job_id, error):
+        self._set_final(job_id, "failed", error=error)
+
+    def _set_final(self, job_id, status, result=None, error=None):
+        # Only a running job can finish: a cancelled one stays cancelled
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, input = NULL,"
+                " progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END, updated = ?"
+                " WHERE id = ? AND status = 'running'",
+                (status, result, error, status, time.time(), job_id),
+            )
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. Returns its status afterwards, or None if unknown."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', input = NULL, updated = ?"
+                " WHERE id = ? AND status IN ('queued', 'running')",
+                (time.time(), job_id),
+            )
+        status = self.status(job_id)
+        return status and status["status"]
+
+    def status(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, task, stage, progress, error, created, updated FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ("id", "status", "task", "stage", "progress", "error", "created", "updated")
+        status = dict(zip(keys, row))
+        status["progress"] = round(status["progress"], 3)
+        return status
+
+    def result(self, job_id):
+        """(result_bytes, media_type) of a finished job, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, media_type FROM jobs WHERE id = ? AND status = 'done'", (job_id,)
+            ).fetchone()
+        return row
+
+    def listener(self, job):
+        return JobProgress(self.path, job["id"], job["task"])
+
+    def _purge(self):
+        self._conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated < ?",
+            (time.time() - self.ttl_seconds,),
+        )
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+
+class JobRunner:
+    """Feeds queued jobs to the inference pool, one loop per worker."""
+
+    def __init__(self, queue, pool, poll_seconds=1.0):
+        self.queue = queue
+        self.pool = pool
+        self.poll_seconds = poll_seconds
+        self._wakeup = None
+        self._tasks = []
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._loop()) for _ in range(self.pool.workers)]
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _loop(self):
+        while True:
+            # Queue calls block on SQLite (and carry blobs): keep them off the event loop
+            job = await asyncio.to_thread(self.queue.claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job):
+        try:
+            result = await self.pool.run(
+                "process_image", job["contents"], task=job["task"], instruction=job["instruction"],
+                params=job["params"], output=job["output"], wait=True, listener=self.queue.listener(job),
+            )
+        except JobCancelled:
+            log.info("Job %s cancelled", job["id"])
+        except Exception as e:
+            log.warning("Job %s failed: %s", job["id"], e)
+            await asyncio.to_thread(self.queue.fail, job["id"], str(e))
+        else:
+            await asyncio.to_thread(self.queue.finish, job["id"], result)
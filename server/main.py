@@ -1,48 +1,428 @@
-from fastapi import FastAPI, UploadFile, File, Form
+import os
+import socket
+
+if __name__ == "__main__":
+    # Electron spawns this script and opens the window right away. Bind before the
+    # imports below, so the frontend's first requests wait in the listen backlog
+    # instead of failing over to the WASM path.
+    listener = socket.create_server(
+        (os.getenv("BATCHBG_HOST", "0.0.0.0"), int(os.getenv("BATCHBG_PORT", 8000))), backlog=128
+    )
+
+import sys
+from typing import List
+from fastapi import FastAPI, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 import uvicorn
+import asyncio
 import base64
-from engine import engine
+import json
+import logging
+import time
+import metrics
+from instrumentation import configure_logging, request_stages, server_timing
+from workers import InferencePool, MicroBatcher, PoolSaturated
+from batch import read_uploads, stream_zip, stream_ndjson, variant_files
+from options import output_options, output_media_type, variant_options
+from uploads import read_upload, content_hash, UploadTooLarge, ImageTooLarge
+from image_store import ImageStore
+from jobs import FINISHED, JobQueue, JobRunner
+
+configure_logging()
+log = logging.getLogger("batchbg.server")
 
 app = FastAPI()
 
+# Inference runs on a bounded worker pool so a long matting job never blocks
+# the event loop (and /health with it). Configure with BATCHBG_WORKERS,
+# BATCHBG_WORKER_MODE (thread|process) and BATCHBG_QUEUE_SIZE.
+pool = InferencePool.from_env()
+# Concurrent REMOVE_BG requests arriving within a few ms share one forward pass.
+# Configure with BATCHBG_MAX_BATCH and BATCHBG_BATCH_WINDOW_MS.
+batcher = MicroBatcher.from_env(pool)
+# Decoded uploads held for interactive edits (BATCHBG_IMAGE_STORE_MB, BATCHBG_IMAGE_TTL)
+image_store = ImageStore.from_env()
+# Async jobs persisted in SQLite (BATCHBG_JOBS_DB, BATCHBG_JOB_TTL, BATCHBG_JOBS_MAX_QUEUED)
+job_queue = JobQueue.from_env()
+job_runner = JobRunner(job_queue, pool)
+metrics.register_pool(pool)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Image-Id", "Retry-After", "Server-Timing"],
 )
 
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    # Stages of the worker jobs run for this request are reported in Server-Timing
+    # (visible in the browser's network panel) and in the /metrics histograms.
+    stages = []
+    token = request_stages.set(stages)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_stages.reset(token)
+    elapsed = time.perf_counter() - start
+
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.labels(
+        route.path if route else "unmatched", request.method, response.status_code
+    ).observe(elapsed)
+    if stages:
+        response.headers["Server-Timing"] = f"{server_timing(stages)}, total;dur={elapsed * 1000:.1f}"
+    return response
+
+@app.on_event("startup")
+async def preload_model():
+    # Warm up in the background: the server binds right away, /ready reports when done.
+    # The engine itself (cv2, numpy, onnxruntime) is imported by the workers there.
+    # BATCHBG_PRELOAD=0 keeps the old lazy model loading on the first request, but
+    # the imports still happen in the background.
+    if not pool.preload:
+        pool.ready = True
+    asyncio.ensure_future(pool.warm_up())
+    job_runner.start()
+
+@app.on_event("shutdown")
+def shutdown_pool():
+    job_runner.stop()
+    pool.shutdown()
+
+def _too_large_response(e):
+    return JSONResponse(status_code=413, content={"error": str(e)})
+
+def _saturated_response(e):
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(e)},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
 @app.get("/health")
 def health_check():
-    return {"status": "ok", "model": "RMBG-1.4"}
+    health = {
+        "status": "ok", "model": "RMBG-1.4", "pool": pool.stats(),
+        "images": image_store.stats(), "jobs": job_queue.stats(),
+    }
+    # Thread workers share this process's result cache. It is null until they have
+    # imported the engine in the background. Process workers each keep their own
+    # cache, which the server cannot see, so the field is left out.
+    if pool.mode == "thread":
+        result_cache = getattr(sys.modules.get("engine"), "result_cache", None)
+        health["cache"] = result_cache.stats() if result_cache else None
+    return health
+
+@app.get("/ready")
+def readiness_check():
+    """Readiness probe: 200 once the model is loaded and warmed up in every worker."""
+    if pool.ready:
+        return {"status": "ready"}
+    status = "failed" if pool.warm_up_error else "warming_up"
+    return JSONResponse(status_code=503, content={"status": status, "error": pool.warm_up_error})
+
+@app.get("/metrics")
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
 
 @app.post("/process")
 async def process_image(
     file: UploadFile = File(...),
     task: str = Form(...),
-    instruction: str = Form(None)
+    instruction: str = Form(None),
+    params: str = Form(None),
+    output: str = Form(None)
 ):
-    print(f"Processing task: {task}")
-    contents = await file.read()
-    
+    log.debug("Processing task: %s", task)
+
     try:
+        # Read in chunks from the spooled upload, up to BATCHBG_MAX_UPLOAD_MB
+        contents = await read_upload(file)
+
+        # Optional JSON object overriding matting pipeline parameters (see DEFAULT_MATTING_PARAMS)
+        pipeline_params = json.loads(params) if params else None
+        # Optional JSON object choosing the encoder (see DEFAULT_OUTPUT_OPTIONS)
+        output_opts = json.loads(output) if output else None
+        media_type = output_media_type(output_opts)
+
         # Currently only supporting 'REMOVE_BG' logic fully via specific engine pipeline
         # 'EDIT' logic currently falls back to the same pipeline if we don't have a GenAI model locally.
         # The Master Prompt for 'BatchBG-Python' mainly specified the specific robust segmentation pipeline.
         # If user wants edits (restorations/erasures), that would be bitwise ops on the frontend or separate endpoint.
         # For now, we map everything to the engine's main process which produces the clean catalog shot.
         
-        output_bytes = engine.process_image(contents, task=task, instruction=instruction)
+        output_bytes = await batcher.submit(
+            contents, task=task, instruction=instruction, params=pipeline_params, output=output_opts
+        )
         
-        # Return as image/png
-        return Response(content=output_bytes, media_type="image/png")
+        return Response(content=output_bytes, media_type=media_type)
         
+    except PoolSaturated as e:
+        log.warning("Rejected: %s", e)
+        return _saturated_response(e)
+    except (UploadTooLarge, ImageTooLarge) as e:
+        log.warning("Rejected: %s", e)
+        return _too_large_response(e)
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {"error": str(e)}
+
+@app.post("/process/batch")
+async def process_batch(
+    files: List[UploadFile] = File(...),
+    task: str = Form(...),
+    instruction: str = Form(None),
+    params: str = Form(None),
+    output: str = Form(None),
+    response_format: str = Form("zip")
+):
+    """
+    Process N images in one request. Results are streamed as each item finishes:
+    - response_format=zip: a ZIP archive (one image per item, <name>.error.txt on failure)
+    - response_format=ndjson: one JSON line per item with the base64 image
+    """
+    log.debug("Processing batch of %d images, task: %s", len(files), task)
+    try:
+        pool.check_admission()
+    except PoolSaturated as e:
+        log.warning("Rejected batch: %s", e)
+        return _saturated_response(e)
+
+    try:
+        pipeline_params = json.loads(params) if params else None
+        output_opts = output_options(json.loads(output)) if output else None
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid params: {e}"})
+
+    try:
+        items = await read_uploads(files)
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    if response_format == "ndjson":
+        return StreamingResponse(
+            stream_ndjson(batcher, items, task, instruction, pipeline_params, output_opts),
+            media_type="application/x-ndjson",
+        )
+    if response_format == "zip":
+        return StreamingResponse(
+            stream_zip(batcher, items, task, instruction, pipeline_params, output_opts),
+            media_type="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="lote-fotos.zip"'},
+        )
+    return JSONResponse(status_code=400, content={"error": f"Unknown response_format: {response_format}"})
+
+@app.post("/process/variants")
+async def process_variants(
+    file: UploadFile = File(...),
+    variants: str = Form(...),
+    params: str = Form(None),
+    response_format: str = Form("zip")
+):
+    """
+    Several deliverables from one segmentation: the image is decoded and matted once,
+    then each variant (canvas, padding_ratio, background, shadow, output options) is
+    rendered from the same alpha. `variants` is a JSON list, see DEFAULT_VARIANT.
+    - response_format=zip: one file per variant, named after it
+    - response_format=json: {"variants": [{"name", "media_type", "data" (base64)}]}
+    """
+    if response_format not in ("zip", "json"):
+        return JSONResponse(status_code=400, content={"error": f"Unknown response_format: {response_format}"})
+    try:
+        variant_list = json.loads(variants)
+        pipeline_params = json.loads(params) if params else None
+        # Reject bad specs here rather than after the matting has run
+        if not isinstance(variant_list, list) or not variant_list:
+            raise ValueError("expected a non-empty JSON list of variant objects")
+        for i, variant in enumerate(variant_list):
+            variant_options(variant, i)
+    except (ValueError, TypeError, AttributeError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid variants: {e}"})
+
+    try:
+        contents = await read_upload(file)
+        results = await pool.run("process_variants", contents, variant_list, params=pipeline_params)
+    except PoolSaturated as e:
+        return _saturated_response(e)
+    except (UploadTooLarge, ImageTooLarge) as e:
+        return _too_large_response(e)
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    if response_format == "json":
+        return {"variants": [
+            {"name": name, "media_type": media_type, "data": base64.b64encode(data).decode("ascii")}
+            for name, media_type, data in results
+        ]}
+    return Response(
+        content=variant_files(results),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="variantes.zip"'},
+    )
+
+@app.post("/images")
+async def upload_image(file: UploadFile = File(...)):
+    """Upload once, decode once. Returns an id to apply operations to with /images/{id}/ops."""
+    try:
+        contents = await read_upload(file)
+        img, content_key = await pool.run("load_image", contents)
+        image_id = image_store.add(img, content_key)
+    except PoolSaturated as e:
+        return _saturated_response(e)
+    except (UploadTooLarge, ImageTooLarge) as e:
+        return _too_large_response(e)
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    h, w = img.shape[:2]
+    return {"id": image_id, "width": w, "height": h, "expires_in": image_store.ttl_seconds}
+
+@app.post("/images/{image_id}/ops")
+async def apply_image_ops(
+    image_id: str,
+    task: str = Form(...),
+    instruction: str = Form(None),
+    params: str = Form(None),
+    output: str = Form(None),
+    keep: bool = Form(False)
+):
+    """
+    Run a task on a held image. The held image is not modified.
+    keep=true also holds the result and returns its id in the X-Image-Id header,
+    so the next edit can chain from it without uploading. The held result keeps
+    full quality even when the response is a preview: fetch it with GET /images/{id}.
+    """
+    held = image_store.get(image_id)
+    if held is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired image id"})
+    img, content_key = held
+
+    try:
+        pipeline_params = json.loads(params) if params else None
+        output_opts = json.loads(output) if output else None
+        media_type = output_media_type(output_opts)
+        output_bytes, result_img = await pool.run(
+            "process_array", img, content_key, task=task, instruction=instruction, params=pipeline_params,
+            output=output_opts, keep=keep
+        )
+    except PoolSaturated as e:
+        return _saturated_response(e)
+    except Exception as e:
+        log.exception("Error: %s", e)
         return {"error": str(e)}
 
+    headers = {}
+    if result_img is not None:
+        headers["X-Image-Id"] = image_store.add(result_img, content_hash(output_bytes))
+    return Response(content=output_bytes, media_type=media_type, headers=headers)
+
+@app.get("/images/{image_id}")
+async def get_image(image_id: str, output: str = None):
+    """Encode a held image, e.g. the full-quality result behind a chain of preview edits."""
+    held = image_store.get(image_id)
+    if held is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired image id"})
+    img, _ = held
+
+    try:
+        output_opts = json.loads(output) if output else None
+        media_type = output_media_type(output_opts)
+        output_bytes = await pool.run("encode_array", img, output=output_opts)
+    except PoolSaturated as e:
+        return _saturated_response(e)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return Response(content=output_bytes, media_type=media_type)
+
+@app.delete("/images/{image_id}")
+def delete_image(image_id: str):
+    return {"deleted": image_store.remove(image_id)}
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    task: str = Form(...),
+    instruction: str = Form(None),
+    params: str = Form(None),
+    output: str = Form(None)
+):
+    """
+    Queue a job and return its id right away, so long jobs don't hold a request
+    open (or hit proxy timeouts). Follow it with GET /jobs/{id} (polling) or
+    GET /jobs/{id}/events (SSE), then fetch GET /jobs/{id}/result.
+    """
+    try:
+        contents = await read_upload(file)
+        pipeline_params = json.loads(params) if params else None
+        output_opts = json.loads(output) if output else None
+        media_type = output_media_type(output_opts)
+        # SQLite writes (with the input blob) run off the event loop
+        job_id = await asyncio.to_thread(
+            job_queue.submit, contents, task, instruction, pipeline_params, output_opts, media_type
+        )
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    except OverflowError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": str(pool.retry_after())})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    job_runner.notify()
+    return await asyncio.to_thread(job_queue.status, job_id)
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    status = job_queue.status(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job id"})
+    return status
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-Sent Events: one `data:` line with the job status at each change, until it finishes."""
+    if await asyncio.to_thread(job_queue.status, job_id) is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job id"})
+
+    async def events():
+        last = None
+        while True:
+            status = await asyncio.to_thread(job_queue.status, job_id)
+            if status is None:
+                return
+            current = (status["status"], status["stage"])
+            if current != last:
+                last = current
+                yield f"data: {json.dumps(status)}\n\n"
+            if status["status"] in FINISHED:
+                return
+            await asyncio.sleep(0.2)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    status = job_queue.status(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job id"})
+    if status["status"] != "done":
+        # Still queued/running (202), or failed/cancelled (409)
+        return JSONResponse(status_code=409 if status["status"] in FINISHED else 202, content=status)
+    result, media_type = job_queue.result(job_id)
+    return Response(content=result, media_type=media_type)
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    """Cancel a queued job, or stop a running one at its next pipeline stage."""
+    status = job_queue.cancel(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job id"})
+    return {"id": job_id, "status": status}
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.Server(uvicorn.Config(app)).run(sockets=[listener])
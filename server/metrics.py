@@ -0,0 +1,33 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+
+# Exported on /metrics. Observed in the HTTP process only: worker processes send
+# their stage timings back with each result.
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    "batchbg_stage_seconds", "Time spent in each pipeline stage", ["stage"], buckets=_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "batchbg_request_seconds", "HTTP request latency", ["route", "method", "status"], buckets=_BUCKETS
+)
+
+
+def observe_stages(stages):
+    for name, seconds in stages:
+        STAGE_SECONDS.labels(name).observe(seconds)
+
+
+def register_pool(pool):
+    Gauge("batchbg_in_flight", "Jobs running on a worker").set_function(
+        lambda: min(pool.pending, pool.workers)
+    )
+    Gauge("batchbg_queue_depth", "Admitted jobs waiting for a worker").set_function(
+        lambda: max(0, pool.pending - pool.workers) + pool.waiting
+    )
+    Gauge("batchbg_pool_ready", "1 once every worker is warmed up").set_function(lambda: int(pool.ready))
+
+
+def render():
+    """(body, content_type) for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
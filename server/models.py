@@ -0,0 +1,198 @@
+"""
+Model files and ONNX Runtime sessions.
+
+- BATCHBG_MODEL_DIR: directory holding <model>.onnx. When set, models are only
+  read from there and never downloaded at runtime; fill it at build time with
+      python models.py prepare
+- BATCHBG_ORT_CACHE_DIR: where ONNX Runtime's optimized graph is saved, so a
+  restart loads it directly and skips graph optimization. Defaults to
+  <BATCHBG_MODEL_DIR>/optimized when a model dir is set.
+- BATCHBG_MODEL / BATCHBG_DRAFT_MODEL: network behind each quality tier.
+  "<name>-int8" is a dynamically quantized copy made by `prepare --quantize`.
+- BATCHBG_ORT_*: session tuning, see session_options().
+"""
+import argparse
+import logging
+import os
+import platform
+import shutil
+
+import onnxruntime as ort
+
+log = logging.getLogger("batchbg.models")
+
+MODEL_DIR = os.getenv("BATCHBG_MODEL_DIR") or None
+ORT_CACHE_DIR = os.getenv("BATCHBG_ORT_CACHE_DIR") or (os.path.join(MODEL_DIR, "optimized") if MODEL_DIR else None)
+
+# Requests choose a tier with the `quality` pipeline parameter
+MODEL_TIERS = {
+    "high": os.getenv("BATCHBG_MODEL", "isnet-general-use"),
+    "draft": os.getenv("BATCHBG_DRAFT_MODEL", "u2netp"),
+}
+
+# Tiers loaded at warm-up. Each worker holds its own copy of every model it loads,
+# so the others load lazily on first use.
+WARM_TIERS = [t.strip() for t in os.getenv("BATCHBG_WARM_TIERS", "high").split(",") if t.strip()]
+
+QUANTIZED_SUFFIX = "-int8"
+
+_IMAGENET = {"mean": (0.485, 0.456, 0.406), "std": (0.229, 0.224, 0.225)}
+
+# Input size and normalization of each network, as rembg feeds them
+MODEL_SPECS = {
+    "isnet-general-use": {"size": 1024, "mean": (0.5, 0.5, 0.5), "std": (1.0, 1.0, 1.0)},
+    "u2net": {"size": 320, **_IMAGENET},
+    "u2netp": {"size": 320, **_IMAGENET},
+    "silueta": {"size": 320, **_IMAGENET},
+}
+
+
+def model_spec(model_name):
+    base = model_name[:-len(QUANTIZED_SUFFIX)] if model_name.endswith(QUANTIZED_SUFFIX) else model_name
+    if base not in MODEL_SPECS:
+        raise ValueError(f"Unsupported model: {model_name}")
+    return MODEL_SPECS[base]
+
+
+def _rembg_session_class(model_name):
+    from rembg.sessions import sessions_class
+    for session_class in sessions_class:
+        if session_class.name() == model_name:
+            return session_class
+    raise ValueError(f"Unknown model: {model_name}")
+
+
+def model_path(model_name):
+    """Local .onnx file of `model_name`. Without BATCHBG_MODEL_DIR, rembg's cache is
+    used (and the model downloaded into it on first use)."""
+    if MODEL_DIR:
+        path = os.path.join(MODEL_DIR, f"{model_name}.onnx")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found; run `python models.py prepare` at build time")
+        return path
+    if model_name.endswith(QUANTIZED_SUFFIX):
+        raise FileNotFoundError("Quantized models need BATCHBG_MODEL_DIR and `python models.py prepare --quantize`")
+    return str(_rembg_session_class(model_name).download_models())
+
+
+def _optimized_path(model_name, source):
+    # The saved graph depends on the ORT version, the architecture and the source model
+    tag = f"{ort.__version__}-{platform.machine()}-{os.path.getsize(source)}"
+    return os.path.join(ORT_CACHE_DIR, f"{model_name}-{tag}.onnx")
+
+
+_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def _intra_threads_share():
+    # Every worker holds its own sessions: split the cores between them
+    # (same default worker count as workers.InferencePool.from_env)
+    cpus = os.cpu_count() or 1
+    workers = int(os.getenv("BATCHBG_WORKERS", min(4, cpus)))
+    return max(1, cpus // max(1, workers))
+
+
+def session_options():
+    """
+    ONNX Runtime session options from the environment:
+    - BATCHBG_ORT_INTRA_THREADS / BATCHBG_ORT_INTER_THREADS: thread pools
+      (default OMP_NUM_THREADS when set, as rembg did; else the intra-op pool gets
+      its share of the cores, so the workers' sessions don't oversubscribe them)
+    - BATCHBG_ORT_OPT_LEVEL: disable | basic | extended | all (default all)
+    - BATCHBG_ORT_ARENA: 0 disables the CPU memory arena (lower peak RSS, slower)
+    - BATCHBG_ORT_EXECUTION_MODE: sequential | parallel (parallel uses the inter-op pool)
+    """
+    opts = ort.SessionOptions()
+    default_threads = os.getenv("OMP_NUM_THREADS")
+    intra = os.getenv("BATCHBG_ORT_INTRA_THREADS", default_threads) or _intra_threads_share()
+    inter = os.getenv("BATCHBG_ORT_INTER_THREADS", default_threads)
+    if intra:
+        opts.intra_op_num_threads = int(intra)
+    if inter:
+        opts.inter_op_num_threads = int(inter)
+
+    opts.graph_optimization_level = _OPT_LEVELS[os.getenv("BATCHBG_ORT_OPT_LEVEL", "all")]
+    opts.enable_cpu_mem_arena = os.getenv("BATCHBG_ORT_ARENA", "1") == "1"
+    opts.execution_mode = _EXECUTION_MODES[os.getenv("BATCHBG_ORT_EXECUTION_MODE", "sequential")]
+    return opts
+
+
+def create_session(model_name):
+    """ONNX Runtime session for `model_name`, loading the cached optimized graph when there is one."""
+    source = model_path(model_name)
+    opts = session_options()
+    if not ORT_CACHE_DIR:
+        return ort.InferenceSession(source, sess_options=opts, providers=["CPUExecutionProvider"])
+
+    cached = _optimized_path(model_name, source)
+    if not os.path.exists(cached):
+        # Save the graph at the EXTENDED level: fusions and constant folding, but no
+        # CPU-specific layout transforms, so a cache built at build time stays portable.
+        # Written under a per-process name and renamed, so workers starting together
+        # never read a half-written file.
+        os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        save_opts = session_options()
+        save_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        save_opts.optimized_model_filepath = tmp
+        ort.InferenceSession(source, sess_options=save_opts, providers=["CPUExecutionProvider"])
+        os.replace(tmp, cached)
+        log.info("Saved optimized graph %s", cached)
+
+    # Only the cheap layout transforms are left to run on the cached graph
+    log.info("Loading optimized graph %s", cached)
+    return ort.InferenceSession(cached, sess_options=opts, providers=["CPUExecutionProvider"])
+
+
+def quantize(model_name):
+    """Write <model>-int8.onnx next to the model: dynamic INT8 quantization of its weights."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    target = os.path.join(MODEL_DIR, f"{model_name}{QUANTIZED_SUFFIX}.onnx")
+    if not os.path.exists(target):
+        quantize_dynamic(model_path(model_name), target, weight_type=QuantType.QUInt8)
+        log.info("Quantized %s -> %s", model_name, target)
+    return f"{model_name}{QUANTIZED_SUFFIX}"
+
+
+def prepare(model_name, with_quantized=False):
+    """Build step: copy the model into BATCHBG_MODEL_DIR and cache its optimized graph."""
+    if not MODEL_DIR:
+        raise SystemExit("BATCHBG_MODEL_DIR is not set")
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    target = os.path.join(MODEL_DIR, f"{model_name}.onnx")
+    if not os.path.exists(target):
+        source = str(_rembg_session_class(model_name).download_models())
+        shutil.copyfile(source, target)
+        log.info("Copied %s -> %s", source, target)
+    create_session(model_name)
+    if with_quantized:
+        create_session(quantize(model_name))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s [%(name)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Fetch models and prebuild their optimized graphs")
+    parser.add_argument("command", choices=["prepare"])
+    parser.add_argument("--model", action="append", help="Model name (repeatable), default: every quality tier")
+    parser.add_argument("--quantize", action="store_true", help="Also build <model>-int8 copies")
+    args = parser.parse_args()
+    for model_name in args.model or sorted(set(MODEL_TIERS.values())):
+        if model_name.endswith(QUANTIZED_SUFFIX):
+            # A tier may point at a quantized copy: prepare its source model
+            prepare(model_name[:-len(QUANTIZED_SUFFIX)], with_quantized=True)
+        else:
+            prepare(model_name, with_quantized=args.quantize)
+
+
+if __name__ == "__main__":
+    main()
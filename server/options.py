@@ -0,0 +1,114 @@
+# Request option parsing: output encoders, variants and shadows. Pure Python, so the
+# server can validate requests without importing the engine (cv2, numpy, onnxruntime).
+
+# Output encoders: requests choose one with an `output` object. The defaults
+# reproduce the original PNG; `preview` swaps in a small JPEG for interactive edits.
+OUTPUT_FORMATS = {
+    # format: (file extension, media type)
+    "png": ("png", "image/png"),
+    "jpeg": ("jpg", "image/jpeg"),
+    "webp": ("webp", "image/webp"),
+}
+
+DEFAULT_OUTPUT_OPTIONS = {
+    "format": "png",
+    "quality": 90,        # JPEG and lossy WebP, 1-100
+    "compression": None,  # PNG zlib level 0-9; None keeps OpenCV's default (fastest)
+    "lossless": False,    # WebP only, keeps the alpha channel of RGBA results intact
+    "preview": False,     # JPEG at most BATCHBG_PREVIEW_DIM on the long side
+}
+
+def output_options(output=None):
+    """Request output options merged over the defaults. Raises ValueError when invalid."""
+    merged = dict(DEFAULT_OUTPUT_OPTIONS)
+    if output:
+        unknown = set(output) - set(merged)
+        if unknown:
+            raise ValueError(f"Unknown output options: {sorted(unknown)}")
+        merged.update(output)
+
+    fmt = "jpeg" if merged["preview"] else str(merged["format"]).lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {merged['format']}")
+    merged["format"] = fmt
+    if not 1 <= int(merged["quality"]) <= 100:
+        raise ValueError("Output quality must be between 1 and 100")
+    if merged["compression"] is not None and not 0 <= int(merged["compression"]) <= 9:
+        raise ValueError("PNG compression must be between 0 and 9")
+    return merged
+
+
+def output_media_type(output=None):
+    return OUTPUT_FORMATS[output_options(output)["format"]][1]
+
+
+# One deliverable rendered from a segmentation (process_variants). Besides these
+# keys a variant takes any output option (format, quality, ...).
+DEFAULT_VARIANT = {
+    "name": None,
+    "canvas": 2048,           # square side, [width, height], or None to keep the original frame
+    "padding_ratio": 0.8,     # share of the canvas the product's long side fills
+    "background": "#ffffff",  # "#rrggbb" or "transparent"
+    "shadow": False,          # True, or shadow options (DEFAULT_SHADOW keys)
+}
+
+# Drop shadow (variants and the EDIT "shadow" op): black, cast by the product's mask
+DEFAULT_SHADOW = {
+    "offset": (20, 20),  # px right/down (negative: left/up)
+    "blur": 31,          # Gaussian kernel size, odd
+    "opacity": 0.3,
+}
+
+
+def shadow_options(shadow=None):
+    """Shadow options merged over the defaults. Raises ValueError when invalid."""
+    shadow = dict(DEFAULT_SHADOW, **(shadow or {}))
+    unknown = set(shadow) - set(DEFAULT_SHADOW)
+    if unknown:
+        raise ValueError(f"Unknown shadow options: {sorted(unknown)}")
+    try:
+        dx, dy = shadow["offset"]
+        shadow["offset"] = (int(dx), int(dy))
+        shadow["blur"] = int(shadow["blur"])
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid shadow offset or blur: {shadow}")
+    if shadow["blur"] < 1 or shadow["blur"] % 2 == 0 or shadow["blur"] > 255:
+        raise ValueError("Shadow blur must be an odd kernel size between 1 and 255")
+    shadow["opacity"] = float(shadow["opacity"])
+    if not 0 <= shadow["opacity"] <= 1:
+        raise ValueError("Shadow opacity must be in [0, 1]")
+    return shadow
+
+
+def _parse_color(value):
+    """"#rrggbb" -> BGR tuple; "transparent"/None -> None."""
+    if value is None or value == "transparent":
+        return None
+    text = str(value).lstrip("#")
+    if len(text) != 6:
+        raise ValueError(f"Invalid background color: {value}")
+    r, g, b = (int(text[i:i + 2], 16) for i in (0, 2, 4))
+    return (b, g, r)
+
+
+def variant_options(variant, index=0):
+    """Variant merged over the defaults, with its output options split out. Raises ValueError when invalid."""
+    if not isinstance(variant, dict):
+        raise ValueError(f"Variant {index + 1} must be a JSON object, got {type(variant).__name__}")
+    layout = {k: variant.get(k, v) for k, v in DEFAULT_VARIANT.items()}
+    output = output_options({k: v for k, v in variant.items() if k not in DEFAULT_VARIANT})
+    layout["name"] = str(layout["name"] or f"variant-{index + 1}")
+    canvas = layout["canvas"]
+    if canvas is not None:
+        w, h = (canvas, canvas) if isinstance(canvas, (int, float)) else canvas
+        if not (0 < int(w) <= 8192 and 0 < int(h) <= 8192):
+            raise ValueError(f"Canvas must be between 1 and 8192 px: {canvas}")
+        layout["canvas"] = (int(w), int(h))
+    if not 0 < float(layout["padding_ratio"]) <= 1:
+        raise ValueError("padding_ratio must be in (0, 1]")
+    layout["background"] = _parse_color(layout["background"])
+    shadow = layout["shadow"]
+    layout["shadow"] = shadow_options(shadow if isinstance(shadow, dict) else None) if shadow else None
+    layout["output"] = output
+    return layout
@@ -0,0 +1,35 @@
+import os
+
+from engine import ResultCache
+from ingest import Manifest
+
+
+def _entry(tmp_path, output, data):
+    path = tmp_path / output
+    path.write_bytes(data)
+    return {
+        "source": "/in/foto.jpg", "output": str(path), "hash": "h", "settings": "s",
+        "size": 1, "mtime_ns": 1,
+        "output_hash": ResultCache.content_hash(data), "output_mtime_ns": os.stat(path).st_mtime_ns,
+    }
+
+
+def test_lookup_requires_same_target(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    entry = _entry(tmp_path, "foto.jpg.png", b"result")
+    manifest.add(entry)
+    assert manifest.lookup("/in/foto.jpg", "s", entry["output"]) == entry
+    # Same source, but this run it maps to another output
+    assert manifest.lookup("/in/foto.jpg", "s", str(tmp_path / "foto.png")) is None
+    manifest.close()
+
+
+def test_lookup_detects_overwritten_output(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    entry = _entry(tmp_path, "foto.png", b"result")
+    manifest.add(entry)
+    with open(entry["output"], "wb") as f:
+        f.write(b"another input's result")
+    os.utime(entry["output"], ns=(1, 1))
+    assert manifest.lookup("/in/foto.jpg", "s", entry["output"]) is None
+    manifest.close()
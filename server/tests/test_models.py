@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import engine
+import models
+from engine import BatchBGEngine, ResultCache
+from models import MODEL_TIERS
+
+
+@pytest.fixture
+def no_thread_env(monkeypatch):
+    monkeypatch.delenv("BATCHBG_ORT_INTRA_THREADS", raising=False)
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+    monkeypatch.setattr(models.os, "cpu_count", lambda: 8)
+
+
+@pytest.mark.parametrize("workers, threads", [("1", 8), ("2", 4), ("3", 2), ("16", 1)])
+def test_intra_threads_split_between_workers(no_thread_env, monkeypatch, workers, threads):
+    monkeypatch.setenv("BATCHBG_WORKERS", workers)
+    assert models.session_options().intra_op_num_threads == threads
+
+
+def test_intra_threads_default_workers(no_thread_env, monkeypatch):
+    # Same default as InferencePool.from_env: min(4, cpus) workers
+    monkeypatch.delenv("BATCHBG_WORKERS", raising=False)
+    assert models.session_options().intra_op_num_threads == 2
+
+
+def test_intra_threads_explicit(no_thread_env, monkeypatch):
+    monkeypatch.setenv("BATCHBG_WORKERS", "2")
+    monkeypatch.setenv("OMP_NUM_THREADS", "3")
+    assert models.session_options().intra_op_num_threads == 3
+    monkeypatch.setenv("BATCHBG_ORT_INTRA_THREADS", "5")
+    assert models.session_options().intra_op_num_threads == 5
+
+
+def _warmed_models(monkeypatch, tiers):
+    monkeypatch.setattr(engine, "WARM_TIERS", tiers)
+    loaded = []
+    instance = BatchBGEngine(cache=ResultCache(max_bytes=0))
+    monkeypatch.setattr(instance, "coarse_masks", lambda images, model_name: loaded.append(model_name))
+    assert instance.warm_up() == loaded
+    return loaded
+
+
+@pytest.mark.skipif("BATCHBG_WARM_TIERS" in os.environ, reason="BATCHBG_WARM_TIERS is set")
+def test_warm_tiers_default_to_high():
+    assert models.WARM_TIERS == ["high"]
+
+
+def test_warm_up_loads_only_warm_tiers(monkeypatch):
+    assert _warmed_models(monkeypatch, ["high"]) == [MODEL_TIERS["high"]]
+    assert _warmed_models(monkeypatch, ["high", "draft"]) == [MODEL_TIERS["high"], MODEL_TIERS["draft"]]
@@ -0,0 +1,36 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+# main opens its job database on import
+os.environ.setdefault("BATCHBG_JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+from options import variant_options  # noqa: E402
+
+
+@pytest.mark.parametrize("variant", ["catalogo", 1, None, ["catalogo"]])
+def test_variant_options_rejects_non_objects(variant):
+    with pytest.raises(ValueError, match="Variant 2 must be a JSON object"):
+        variant_options(variant, 1)
+
+
+@pytest.mark.parametrize("variants", [
+    {"name": "catalogo"},
+    "catalogo",
+    [],
+    ["catalogo", "miniatura"],
+    [{"name": "catalogo"}, 3],
+])
+def test_process_variants_rejects_non_list_of_objects(variants):
+    # No lifespan: the pool never starts, validation answers before any work
+    client = TestClient(main.app)
+    response = client.post(
+        "/process/variants", files={"file": ("a.jpg", b"not an image")}, data={"variants": json.dumps(variants)}
+    )
+    assert response.status_code == 400
+    assert response.json()["error"].startswith("Invalid variants:")
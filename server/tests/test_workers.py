@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import workers
+from workers import InferencePool, MicroBatcher, PoolSaturated
+
+
+def _fake_call(method, args, kwargs, submitted, listener=None):
+    time.sleep(0.05)
+    if method == "process_many":
+        return [(kwargs.get("output"), contents) for contents in args[0]], []
+    return (kwargs.get("output"), args[0]), []
+
+
+@pytest.fixture
+def fake_engine(monkeypatch):
+    # Workers answer without loading the engine
+    monkeypatch.setattr(workers, "_call", _fake_call)
+    monkeypatch.setattr(workers, "_warm_up", lambda models=True: None)
+
+
+def test_run_counts_reserved_slots(fake_engine):
+    async def scenario():
+        pool = InferencePool(workers=1, max_queue=1)
+        # Both slots held by requests waiting for a micro-batch
+        pool.reserve()
+        pool.reserve()
+        with pytest.raises(PoolSaturated):
+            await pool.run("process_image", b"img")
+        pool.release(2)
+        assert await pool.run("process_image", b"img") == (None, b"img")
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_batcher_rejects_past_capacity(fake_engine):
+    async def scenario():
+        pool = InferencePool(workers=1, max_queue=1)
+        batcher = MicroBatcher(pool, max_batch=4)
+        results = await asyncio.gather(*(batcher.submit(b"img") for _ in range(6)), return_exceptions=True)
+        assert sum(isinstance(r, PoolSaturated) for r in results) == 4
+        assert pool.waiting == 0 and pool.pending == 0
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_batcher_groups_by_settings(fake_engine, monkeypatch):
+    jobs = []
+    original = MicroBatcher.run_many
+
+    async def run_many(self, items, **kwargs):
+        jobs.append((len(items), kwargs["output"]))
+        return await original(self, items, **kwargs)
+
+    monkeypatch.setattr(MicroBatcher, "run_many", run_many)
+
+    async def scenario():
+        pool = InferencePool(workers=2, max_queue=8)
+        batcher = MicroBatcher(pool, max_batch=4, window_ms=20)
+        png, webp = {"format": "png"}, {"format": "webp"}
+        results = await asyncio.gather(
+            *(batcher.submit(b"a", output=dict(png)) for _ in range(3)),
+            *(batcher.submit(b"b", output=dict(webp)) for _ in range(2)),
+        )
+        assert results == [(png, b"a")] * 3 + [(webp, b"b")] * 2
+        pool.shutdown()
+
+    asyncio.run(scenario())
+    assert sorted(jobs, key=lambda job: job[0]) == [(2, {"format": "webp"}), (3, {"format": "png"})]
+
+
+class _FakeEngine:
+    warmed = []
+    fail = False
+
+    def warm_up(self):
+        if self.fail:
+            raise RuntimeError("model not found")
+        self.warmed.append(threading.get_ident())
+
+
+def test_warm_up_runs_in_every_worker(monkeypatch):
+    job_threads = set()
+
+    def call(*args, **kwargs):
+        job_threads.add(threading.get_ident())
+        return _fake_call(*args, **kwargs)
+
+    monkeypatch.setattr(workers, "_call", call)
+    monkeypatch.setattr(workers, "_worker_engine", _FakeEngine)
+    monkeypatch.setattr(_FakeEngine, "warmed", [])
+
+    async def scenario():
+        pool = InferencePool(workers=3, max_queue=3)
+        await pool.warm_up()
+        await asyncio.gather(*(pool.run("process_image", b"img") for _ in range(6)))
+        pool.shutdown()
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert pool.ready and pool.warm_up_error is None
+    # Once per worker thread, by the executor initializer, before any job ran there
+    assert len(_FakeEngine.warmed) == len(set(_FakeEngine.warmed)) == 3
+    assert job_threads <= set(_FakeEngine.warmed)
+
+
+def test_failed_warm_up_keeps_pool_usable(monkeypatch):
+    monkeypatch.setattr(workers, "_call", _fake_call)
+    monkeypatch.setattr(workers, "_worker_engine", _FakeEngine)
+    monkeypatch.setattr(_FakeEngine, "fail", True)
+
+    async def scenario():
+        pool = InferencePool(workers=2, max_queue=0)
+        await pool.warm_up()
+        result = await pool.run("process_image", b"img")
+        pool.shutdown()
+        return pool, result
+
+    pool, result = asyncio.run(scenario())
+    assert not pool.ready and pool.warm_up_error == "model not found"
+    assert result == (None, b"img")
@@ -0,0 +1,39 @@
+import hashlib
+import os
+
+# Starlette spools uploads (in memory up to 1 MB, then to a temp file). Reading
+# them back in chunks means an oversized file is rejected after at most
+# max_bytes have been loaded, instead of after loading all of it.
+MAX_UPLOAD_BYTES = int(os.getenv("BATCHBG_MAX_UPLOAD_MB", 50)) * 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an uploaded file exceeds BATCHBG_MAX_UPLOAD_MB."""
+
+
+class ImageTooLarge(ValueError):
+    """Raised when an input's header declares more than BATCHBG_MAX_PIXELS pixels."""
+
+
+async def read_upload(upload, max_bytes=MAX_UPLOAD_BYTES):
+    too_large = UploadTooLarge(f"{upload.filename or 'Upload'} exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+    if upload.size is not None and upload.size > max_bytes:
+        raise too_large
+
+    chunks = []
+    total = 0
+    while True:
+        chunk = await upload.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def content_hash(data):
+    """Content key of an upload or an encoded result (the result cache and image store key on it)."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
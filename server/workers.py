@@ -0,0 +1,317 @@
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from instrumentation import collect, configure_logging, record, request_stages
+from metrics import observe_stages
+
+log = logging.getLogger("batchbg.pool")
+
+# Each worker (thread or process) owns its own engine, and therefore its own
+# ONNX session. Sessions are created lazily on the first job a worker runs.
+# The engine module (cv2, numpy, onnxruntime) is only imported by the workers,
+# so the server binds and answers before it has loaded.
+_local = threading.local()
+
+
+def _worker_engine():
+    engine = getattr(_local, "engine", None)
+    if engine is None:
+        # Spawned worker processes start without the server's logging setup
+        configure_logging()
+        from engine import BatchBGEngine
+        engine = BatchBGEngine()
+        _local.engine = engine
+    return engine
+
+
+def _warm_up(models=True):
+    # Executor initializer: runs in every worker before it takes its first job.
+    # A failure is kept for _worker_status instead of breaking the pool, so
+    # requests can still retry loading the model lazily.
+    try:
+        engine = _worker_engine()
+        if models:
+            engine.warm_up()
+    except Exception as e:
+        log.exception("Worker warm-up failed")
+        _local.warm_up_error = str(e)
+
+
+def _worker_status():
+    # Module-level for the process pool, like _call. A worker only takes jobs once
+    # its initializer is done, so an answer means that worker is warm. The short
+    # sleep keeps an already warm worker from answering for all the others.
+    time.sleep(0.05)
+    return f"{os.getpid()}:{threading.get_ident()}", getattr(_local, "warm_up_error", None)
+
+
+def _call(method, args, kwargs, submitted, listener=None):
+    # Module-level so it can be pickled into a process pool.
+    # Returns (result, stages). time.monotonic is system-wide, so the queue wait
+    # is measured correctly from a worker process too.
+    queued = time.monotonic() - submitted
+    result, stages = collect(getattr(_worker_engine(), method), *args, listener=listener, **kwargs)
+    return result, [("queue", queued)] + stages
+
+
+class PoolSaturated(Exception):
+    """Raised when the admission queue is full. Carries a Retry-After hint in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    """
+    Bounded pool of engine workers.
+    - mode "thread": cheap, shares memory; ONNX Runtime and OpenCV release the GIL.
+    - mode "process": full isolation, one interpreter per core.
+    At most `workers + max_queue` jobs are admitted at once; the rest are rejected
+    with PoolSaturated so the HTTP layer can answer 503 + Retry-After.
+    """
+
+    def __init__(self, workers=1, mode="thread", max_queue=4, preload=True):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown worker mode: {mode}")
+
+        self.workers = max(1, int(workers))
+        self.mode = mode
+        self.max_queue = max(0, int(max_queue))
+        self.capacity = self.workers + self.max_queue
+        # preload=False only imports the engine in each worker (lazy model loading)
+        self.preload = preload
+
+        if mode == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up,
+                initargs=(preload,),
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix="batchbg-worker",
+                initializer=_warm_up,
+                initargs=(preload,),
+            )
+
+        self._pending = 0
+        self._waiters = 0
+        # Requests admitted but held back to be batched (MicroBatcher)
+        self._reserved = 0
+        self._slot_freed = None
+        self._loop = None
+        # Exponential moving average of job duration, used for Retry-After.
+        self._avg_job_seconds = 2.0
+        # Set once warm_up has loaded the model in every worker
+        self.ready = False
+        self.warm_up_error = None
+
+    @classmethod
+    def from_env(cls):
+        default_workers = min(4, os.cpu_count() or 1)
+        workers = int(os.getenv("BATCHBG_WORKERS", default_workers))
+        mode = os.getenv("BATCHBG_WORKER_MODE", "thread")
+        max_queue = int(os.getenv("BATCHBG_QUEUE_SIZE", workers * 4))
+        preload = os.getenv("BATCHBG_PRELOAD", "1") == "1"
+        return cls(workers=workers, mode=mode, max_queue=max_queue, preload=preload)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def waiting(self):
+        return self._waiters + self._reserved
+
+    def retry_after(self):
+        backlog = max(1, self._pending - self.workers + 1)
+        return max(1, math.ceil(self._avg_job_seconds * backlog / self.workers))
+
+    def check_admission(self):
+        """Raise PoolSaturated if a new request would not fit in the queue right now."""
+        if self._pending + self._waiters + self._reserved >= self.capacity:
+            raise PoolSaturated(self.retry_after())
+
+    def reserve(self):
+        """Admit a request that will run later as part of a batch; it holds a queue slot until release()."""
+        self.check_admission()
+        self._reserved += 1
+
+    def release(self, count=1):
+        self._reserved -= count
+
+    async def run(self, method, *args, wait=False, listener=None, **kwargs):
+        """
+        Run `BatchBGEngine.<method>(*args, **kwargs)` on a worker.
+        wait=False rejects immediately when the queue is full (interactive requests);
+        wait=True waits for a free slot instead (items of an already admitted batch).
+        listener: picklable callable told of each stage as it starts (see jobs.py).
+        """
+        submitted = time.monotonic()
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio primitives bind to the loop that first uses them
+            self._slot_freed = asyncio.Condition()
+            self._loop = loop
+
+        if not wait:
+            # Same count as reserve(): slots held by waiting and batched requests are taken
+            self.check_admission()
+        if self._pending >= self.capacity:
+            self._waiters += 1
+            try:
+                async with self._slot_freed:
+                    await self._slot_freed.wait_for(lambda: self._pending < self.capacity)
+            finally:
+                self._waiters -= 1
+
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            result, stages = await loop.run_in_executor(self._executor, _call, method, args, kwargs, submitted, listener)
+            observe_stages(stages)
+            record(stages)
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * elapsed
+            self._pending -= 1
+            async with self._slot_freed:
+                self._slot_freed.notify()
+
+    async def warm_up(self):
+        """
+        Start every worker and wait until each has run its warm-up initializer
+        (model load and a dummy inference, or only the engine import without preload).
+        The executor starts workers on demand and any of them may take a given job,
+        so status checks are sent until every worker has answered.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        answered = {}
+        try:
+            while len(answered) < self.workers:
+                answered.update(await asyncio.gather(*(
+                    loop.run_in_executor(self._executor, _worker_status) for _ in range(self.workers)
+                )))
+        except Exception as e:
+            self.warm_up_error = str(e)
+            log.error("Warm-up failed: %s", e)
+            return
+        errors = [error for error in answered.values() if error]
+        if errors:
+            self.warm_up_error = errors[0]
+            log.error("Warm-up failed in %d worker(s): %s", len(errors), errors[0])
+            return
+        self.ready = True
+        log.info("%d worker(s) warmed up in %.1fs", self.workers, time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "ready": self.ready,
+            "workers": self.workers,
+            "pending": self._pending,
+            "waiting": self.waiting,
+            "capacity": self.capacity,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MicroBatcher:
+    """
+    Coalesces REMOVE_BG requests that arrive within `window_ms` of each other into a
+    single process_many job, so they share one forward pass of the network.
+    Requests are grouped by (task, instruction, params, output): only requests with
+    the same settings share a batch. max_batch=1 disables batching and forwards
+    straight to process_image.
+    """
+
+    def __init__(self, pool, max_batch=4, window_ms=10):
+        self.pool = pool
+        self.max_batch = max(1, int(max_batch))
+        self.window_ms = window_ms
+        # Group key -> (settings, [(contents, future, stage collector)])
+        self._waiting = {}
+        self._flush_handles = {}
+
+    @classmethod
+    def from_env(cls, pool):
+        max_batch = int(os.getenv("BATCHBG_MAX_BATCH", 4))
+        window_ms = float(os.getenv("BATCHBG_BATCH_WINDOW_MS", 10))
+        return cls(pool, max_batch=max_batch, window_ms=window_ms)
+
+    async def submit(self, contents, task="REMOVE_BG", instruction=None, params=None, output=None):
+        # Only REMOVE_BG shares work (the forward pass) between images
+        if task != "REMOVE_BG" or self.max_batch == 1:
+            return await self.pool.run(
+                "process_image", contents, task=task, instruction=instruction, params=params, output=output
+            )
+
+        # Each waiting request holds a queue slot, so batched traffic stays within
+        # the pool's capacity; the slots pass to the batch job when it starts
+        self.pool.reserve()
+        group = (task, instruction, json.dumps(params, sort_keys=True), json.dumps(output, sort_keys=True))
+        settings = {"task": task, "instruction": instruction, "params": params, "output": output}
+        _, items = self._waiting.setdefault(group, (settings, []))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # The batch job's stages are credited to every request in it
+        items.append((contents, future, request_stages.get()))
+
+        if len(items) >= self.max_batch:
+            self._flush(group)
+        elif group not in self._flush_handles:
+            self._flush_handles[group] = loop.call_later(self.window_ms / 1000, self._flush, group)
+        return await future
+
+    async def run_many(self, items, task="REMOVE_BG", instruction=None, params=None, output=None):
+        """Run an already admitted group of images as one job (waits for a free slot)."""
+        return await self.pool.run(
+            "process_many", items, task=task, instruction=instruction, params=params, output=output,
+            max_batch=self.max_batch, wait=True
+        )
+
+    def _flush(self, group):
+        handle = self._flush_handles.pop(group, None)
+        if handle is not None:
+            handle.cancel()
+        settings, waiting = self._waiting.pop(group, (None, []))
+        if waiting:
+            asyncio.ensure_future(self._run(waiting, settings))
+
+    async def _run(self, waiting, settings):
+        stages = []
+        token = request_stages.set(stages)
+        # The requests were admitted one by one: the batch job takes their place
+        # (waiting for a free slot if needed) rather than being admitted again
+        self.pool.release(len(waiting))
+        try:
+            results = await self.run_many([contents for contents, _, _ in waiting], **settings)
+        except Exception as e:
+            results = [e] * len(waiting)
+        finally:
+            request_stages.reset(token)
+
+        for (_, future, collector), result in zip(waiting, results):
+            if collector is not None:
+                collector.extend(stages)
+            if future.done():
+                # Caller disconnected
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
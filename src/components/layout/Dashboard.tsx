@@ -4,17 +4,40 @@ import JSZip from 'jszip';
 import { useState } from 'react';
 import { DownloadOptionsModal } from '../common/DownloadOptionsModal';
 
-import { processImageWithGemini } from '../../services/api';
+import { processImageWithGemini, processBatchWithServer } from '../../services/api';
 
 export function Dashboard() {
     const { images, selectImage, deleteImage, addImage, updateImage } = useStudio();
     const [downloadModalOpen, setDownloadModalOpen] = useState(false);
 
     const handleBatchProcess = async () => {
-        const idleImages = images.filter(img => img.status === 'idle');
+        let idleImages = images.filter(img => img.status === 'idle');
         if (idleImages.length === 0) return;
 
-        // Concurrency Control: Process 3 at a time
+        // TRY 1: Whole batch in a single request to the local server
+        const finished = new Set<string>();
+        try {
+            idleImages.forEach(img => updateImage(img.id, { status: 'processing', progress: 0 }));
+            await processBatchWithServer(
+                idleImages.map(img => ({ base64: img.original, filename: img.filename })),
+                'REMOVE_BG',
+                (index, result) => {
+                    const img = idleImages[index];
+                    finished.add(img.id);
+                    if (result) {
+                        updateImage(img.id, { status: 'done', processed: result, progress: 100 });
+                    } else {
+                        updateImage(img.id, { status: 'error' });
+                    }
+                }
+            );
+        } catch (err) {
+            console.warn("Batch endpoint unavailable, processing one by one", err);
+        }
+        idleImages = idleImages.filter(img => !finished.has(img.id));
+        if (idleImages.length === 0) return;
+
+        // FALLBACK: one request per image. Concurrency Control: Process 3 at a time
         const CONCURRENCY_LIMIT = 3;
         const queue = [...idleImages];
         const activePromises: Promise<void>[] = [];
@@ -71,7 +94,10 @@ export function Dashboard() {
             const nameWithoutExt = imgData.filename.replace(/\.[^/.]+$/, "");
             const filename = `${nameWithoutExt}-editado`;
 
-            if (useWhiteBackground) {
+            if (src.startsWith('data:image/jpeg')) {
+                // Already an opaque JPEG encoded by the server: store it as is
+                zip.file(`${filename}.jpg`, src.split(',')[1], { base64: true });
+            } else if (useWhiteBackground) {
                 // Composite
                 const img = new Image();
                 img.crossOrigin = 'anonymous';
@@ -86,8 +86,106 @@ const applyAlphaThreshold = async (base64: string, threshold: number): Promise<s
     return canvas.toDataURL('image/png');
 };
 
+const blobToDataUrl = (blob: Blob): Promise<string> => {
+    return new Promise((resolve, reject) => {
+        const reader = new FileReader();
+        reader.onloadend = () => resolve(reader.result as string);
+        reader.onerror = reject;
+        reader.readAsDataURL(blob);
+    });
+};
+
+// Server-side image handles: data URL -> id of the decoded copy held by the server.
+// Edits chain from the returned handle instead of re-uploading the whole image.
+const serverHandles = new Map<string, string>();
+const MAX_SERVER_HANDLES = 50;
+
+const rememberHandle = (dataUrl: string, id: string) => {
+    serverHandles.set(dataUrl, id);
+    if (serverHandles.size > MAX_SERVER_HANDLES) {
+        const oldest = serverHandles.keys().next().value;
+        if (oldest !== undefined) serverHandles.delete(oldest);
+    }
+};
+
+const uploadToServer = async (base64Img: string): Promise<string> => {
+    const formData = new FormData();
+    formData.append('file', await (await fetch(base64Img)).blob());
+    const response = await fetch('http://localhost:8000/images', { method: 'POST', body: formData });
+    if (!response.ok) throw new Error(`Server responded with ${response.status}`);
+    const { id } = await response.json();
+    rememberHandle(base64Img, id);
+    return id;
+};
+
+const editWithServerHandle = async (base64Img: string, task: string, instruction?: string): Promise<string> => {
+    for (let attempt = 0; attempt < 2; attempt++) {
+        const id = serverHandles.get(base64Img) || await uploadToServer(base64Img);
+
+        const formData = new FormData();
+        formData.append('task', task);
+        if (instruction) formData.append('instruction', instruction);
+        formData.append('keep', 'true');
+
+        const response = await fetch(`http://localhost:8000/images/${id}/ops`, { method: 'POST', body: formData });
+        if (response.status === 404) {
+            // Expired on the server: upload again
+            serverHandles.delete(base64Img);
+            continue;
+        }
+        if (!response.ok) throw new Error(`Server responded with ${response.status}`);
+
+        const result = await blobToDataUrl(await response.blob());
+        const resultId = response.headers.get('X-Image-Id');
+        if (resultId) rememberHandle(result, resultId);
+        return result;
+    }
+    throw new Error('Server image handle expired');
+};
+
+// The catalog shot is opaque (white background): the server encodes it once as JPEG,
+// so the ZIP download can store it as is instead of re-encoding in the browser.
+const CATALOG_OUTPUT = JSON.stringify({ format: 'jpeg', quality: 92 });
+
+// Background removal goes through the job API: the POST returns at once (no proxy
+// timeout on long jobs) and progress follows the server's pipeline stages.
+const waitForJob = (id: string, onProgress?: (percent: number) => void): Promise<void> => {
+    return new Promise((resolve, reject) => {
+        const events = new EventSource(`http://localhost:8000/jobs/${id}/events`);
+        events.onmessage = (event) => {
+            const job = JSON.parse(event.data);
+            if (onProgress) onProgress(10 + Math.round(job.progress * 85));
+            if (job.status === 'done') {
+                events.close();
+                resolve();
+            } else if (job.status === 'failed' || job.status === 'cancelled') {
+                events.close();
+                reject(new Error(job.error || `Job ${job.status}`));
+            }
+        };
+        events.onerror = () => {
+            events.close();
+            reject(new Error('Lost the job progress stream'));
+        };
+    });
+};
+
 // Helper to call local Python server
-const processWithServer = async (base64Img: string, task: string, instruction?: string): Promise<string> => {
+const processWithServer = async (
+    base64Img: string,
+    task: string,
+    instruction?: string,
+    onProgress?: (percent: number) => void
+): Promise<string> => {
+    if (task === 'EDIT') {
+        try {
+            return await editWithServerHandle(base64Img, task, instruction);
+        } catch (error) {
+            console.warn("Local server unreachable or failed, falling back to WASM", error);
+            throw error;
+        }
+    }
+
     const formData = new FormData();
     // Convert base64 to blob
     const res = await fetch(base64Img);
@@ -95,32 +193,89 @@ const processWithServer = async (base64Img: string, task: string, instruction?:
     formData.append('file', blob);
     formData.append('task', task);
     if (instruction) formData.append('instruction', instruction);
+    if (task === 'REMOVE_BG') formData.append('output', CATALOG_OUTPUT);
 
     try {
         // Since we are running in Electron or local, localhost:8000 is accessible.
-        const response = await fetch('http://localhost:8000/process', {
+        let response = await fetch('http://localhost:8000/jobs', {
             method: 'POST',
             body: formData,
         });
 
+        // Server backlog is full: honour Retry-After instead of dropping to the slow WASM path
+        for (let attempt = 0; response.status === 503 && attempt < 3; attempt++) {
+            const retryAfter = parseInt(response.headers.get('Retry-After') || '1', 10);
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            response = await fetch('http://localhost:8000/jobs', {
+                method: 'POST',
+                body: formData,
+            });
+        }
+
         if (!response.ok) {
             throw new Error(`Server responded with ${response.status}`);
         }
 
-        const resultBlob = await response.blob();
+        const { id } = await response.json();
+        await waitForJob(id, onProgress);
+        const result = await fetch(`http://localhost:8000/jobs/${id}/result`);
+        if (!result.ok) {
+            throw new Error(`Server responded with ${result.status}`);
+        }
+
+        const resultBlob = await result.blob();
         // Convert to base64
-        return new Promise((resolve, reject) => {
-            const reader = new FileReader();
-            reader.onloadend = () => resolve(reader.result as string);
-            reader.onerror = reject;
-            reader.readAsDataURL(resultBlob);
-        });
+        return await blobToDataUrl(resultBlob);
     } catch (error) {
         console.warn("Local server unreachable or failed, falling back to WASM", error);
         throw error;
     }
 };
 
+// Batch: one multipart request for N images, results streamed back as NDJSON lines
+// as each item finishes on the server.
+export async function processBatchWithServer(
+    images: { base64: string, filename: string }[],
+    task: StudioTask,
+    onItem: (index: number, result: string | null) => void
+): Promise<void> {
+    const formData = new FormData();
+    for (const img of images) {
+        const blob = await (await fetch(img.base64)).blob();
+        formData.append('files', blob, img.filename);
+    }
+    formData.append('task', task);
+    if (task === 'REMOVE_BG') formData.append('output', CATALOG_OUTPUT);
+    formData.append('response_format', 'ndjson');
+
+    const response = await fetch('http://localhost:8000/process/batch', {
+        method: 'POST',
+        body: formData,
+    });
+    if (!response.ok || !response.body) {
+        throw new Error(`Server responded with ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = '';
+    const handleLine = (line: string) => {
+        if (!line.trim()) return;
+        const item = JSON.parse(line);
+        onItem(item.index, item.status === 'ok' ? `data:${item.media_type};base64,${item.data}` : null);
+    };
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffered += decoder.decode(value, { stream: true });
+        const lines = buffered.split('\n');
+        buffered = lines.pop() || '';
+        lines.forEach(handleLine);
+    }
+    handleLine(buffered);
+}
+
 export async function processImageWithGemini(
     imageBase64: string,
     task: StudioTask,
@@ -133,7 +288,7 @@ export async function processImageWithGemini(
     try {
         if (onProgress) onProgress(10);
         logger.log("Intentando conectar con servidor Python local (Alta Calidad)...");
-        const serverResult = await processWithServer(imageBase64, task, userInstruction || '');
+        const serverResult = await processWithServer(imageBase64, task, userInstruction || '', onProgress);
         if (onProgress) onProgress(100);
         logger.log("¡Procesado exitoso en servidor local!");
         return serverResult;